@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""End-to-end benchmarks against the local fake Adzerk (fake_adzerk.py).
+
+Nothing talks to api.adzerk.net or engine.adzerk.net, and no reddit
+install is needed: both suites only need pylons and requests. There are
+two suites.
+
+plugin runs the plugin's own code for --campaigns live campaigns kept in
+memory by fake_reddit.py (nothing is written to a database, memcache or
+amqp). make_adzerk_promotions queues the daily sweep to the bulk lane and
+process_adzerk consumes it, running _update_adzerk with the planner and
+fingerprints. It reports the wall time, messages per second, API calls
+per message and per message latency of a cold (creating), warm
+(unchanged) and forced (drift check) sweep, then adzerk_request p50/p99
+latency:
+
+    python benchmarks/bench_e2e.py plugin --campaigns 200 --latency-ms 5
+
+api times the management API client on its own (create, get, put and
+paged list calls) and raw decision round trips through the engine
+transport:
+
+    python benchmarks/bench_e2e.py api --objects 200 --latency-ms 5
+
+Both suites take --latency-ms, --jitter-ms, --error-rate and --rate-limit
+to shape the fake.
+
+"""
+
+import argparse
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'reddit_adzerk'))
+from fake_adzerk import FakeAdzerk
+import fake_reddit
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    index = min(len(samples) - 1, int(round(p / 100. * (len(samples) - 1))))
+    return samples[index]
+
+
+def report_latency(name, samples):
+    print('%-28s n=%-6d p50=%7.2fms p99=%7.2fms max=%7.2fms' % (
+        name, len(samples),
+        percentile(samples, 50) * 1000,
+        percentile(samples, 99) * 1000,
+        max(samples or [0]) * 1000,
+    ))
+
+
+def timed(samples, fn, *a, **kw):
+    start = time.time()
+    try:
+        return fn(*a, **kw)
+    finally:
+        samples.append(time.time() - start)
+
+
+def start_fake(args):
+    return FakeAdzerk(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      error_rate=args.error_rate, rate_limit=args.rate_limit,
+                      fill_rate=args.fill_rate, seed=0).start()
+
+
+def push_globals(g_obj):
+    from pylons import c, g
+    g._push_object(g_obj)
+    c._push_object(object())
+
+
+# api suite
+
+
+def campaign_kw(i):
+    return dict(Name='t3_%d' % i, AdvertiserId=1, Flights=[],
+                StartDate='/Date(1420099200000)/', IsDeleted=False,
+                IsActive=True, Price=0)
+
+
+def flight_kw(i, campaign_id):
+    return dict(Name='t8_%d' % i, StartDate='/Date(1420099200000)/',
+                EndDate='/Date(1420185600000)/', Price=1.25, OptionType=1,
+                Impressions=10500, IsUnlimited=False, IsFullSpeed=False,
+                Keywords='pics', CampaignId=campaign_id, PriorityId=1,
+                IsDeleted=False, IsActive=True)
+
+
+def creative_kw(i):
+    return dict(Title='t3_%d-t8_%d' % (i, i), Body='title %d' % i,
+                Url='http://example.com/%d' % i, AdvertiserId=1, AdTypeId=5,
+                Alt='', IsSync=False, IsDeleted=False, IsActive=True)
+
+
+def cfmap_kw(campaign_id, flight_id, creative_id):
+    return dict(SizeOverride=False, CampaignId=campaign_id,
+                PublisherAccountId=1, IsDeleted=False, Percentage=100,
+                Iframe=False, Creative={'Id': creative_id}, IsActive=True,
+                FlightId=flight_id, Impressions=100, DistributionType=2)
+
+
+def run_api(args):
+    g_obj = fake_reddit.Globals({'az_api_page_size': args.page_size})
+    push_globals(g_obj)
+    import adzerk_api
+
+    fake = start_fake(args)
+    adzerk_api.Base._base_url = fake.api_url
+    adzerk_api.set_transport(adzerk_api.Transport(
+        pool_maxsize=args.concurrency))
+    samples = {}
+
+    def sample(name):
+        return samples.setdefault(name, [])
+
+    objects = []
+    for i in xrange(args.objects):
+        campaign = timed(sample('campaign create'),
+                         adzerk_api.Campaign.create, **campaign_kw(i))
+        flight = timed(sample('flight create'), adzerk_api.Flight.create,
+                       **flight_kw(i, campaign.Id))
+        creative = timed(sample('creative create'),
+                         adzerk_api.Creative.create, **creative_kw(i))
+        cfmap = timed(sample('flight_creative create'),
+                      adzerk_api.CreativeFlightMap.create, flight.Id,
+                      **cfmap_kw(campaign.Id, flight.Id, creative.Id))
+        objects.append((campaign.Id, flight.Id, creative.Id, cfmap.Id))
+
+    def get_and_put(ids):
+        campaign_id, flight_id, creative_id, cfmap_id = ids
+        with adzerk_api.unit_of_work():
+            for thing in (
+                timed(sample('campaign get'), adzerk_api.Campaign.get,
+                      campaign_id),
+                timed(sample('creative get'), adzerk_api.Creative.get,
+                      creative_id),
+                timed(sample('flight get'), adzerk_api.Flight.get,
+                      flight_id),
+                timed(sample('flight_creative get'), adzerk_api.CreativeFlightMap.get,
+                      flight_id, cfmap_id),
+            ):
+                timed(sample('%s put' % thing._resource()), thing._send)
+
+    pool = ThreadPool(args.concurrency, initializer=push_globals,
+                      initargs=(g_obj,))
+    fake.reset_calls()
+    start = time.time()
+    pool.map(get_and_put, objects)
+    elapsed = time.time() - start
+    calls = fake.total_calls()
+
+    start = time.time()
+    listed = timed(sample('campaign list (all pages)'),
+                   adzerk_api.Campaign.list)
+    list_elapsed = time.time() - start
+
+    def decide(i):
+        transport = adzerk_api.get_engine_transport()
+        payload = ('{"placements": [{"divName": "div0", "networkId": 1, '
+                   '"siteId": 1, "adTypes": [5]}], "keywords": ["k%d"]}' % i)
+        response = transport.request(
+            'POST', fake.engine_url, data=payload,
+            headers={'content-type': 'application/json'})
+        response.json()
+
+    decisions = sample('decision round trip')
+    pool.map(lambda i: timed(decisions, decide, i), xrange(args.requests))
+    pool.close()
+    pool.join()
+    adzerk_api.set_transport(None)
+    fake.stop()
+
+    print('get and put of %d x 4 objects: %d calls in %.2fs, %.1f calls/s'
+          % (len(objects), calls, elapsed, calls / elapsed))
+    print('listed %d campaigns in %.2fs' % (len(listed or []), list_elapsed))
+    for name in sorted(samples):
+        report_latency(name, samples[name])
+
+
+# plugin suite
+
+
+def run_plugin(args):
+    fake_reddit.install()
+    g_obj = fake_reddit.Globals({
+        'az_api_page_size': args.page_size,
+        'az_api_pool_maxsize': max(10, args.concurrency),
+        'az_consumer_batch_size': args.batch_size,
+        'az_consumer_link_workers': args.link_workers,
+        'az_consumer_stage_workers': args.stage_workers,
+        'az_optimistic_locking': args.optimistic,
+    })
+    push_globals(g_obj)
+    import adzerk_api
+    import adzerkpromote
+    import workers
+
+    fake = start_fake(args)
+    adzerk_api.Base._base_url = fake.api_url
+    adzerkpromote.ADZERK_ENGINE_URL = fake.engine_url
+    fake_reddit.make_campaigns(args.campaigns, args.keyword_sets)
+
+    latencies = []
+    handle_adzerk_message = adzerkpromote.handle_adzerk_message
+
+    def timed_handle(data):
+        timed(latencies, handle_adzerk_message, data)
+    adzerkpromote.handle_adzerk_message = timed_handle
+
+    bulk_queue = adzerkpromote.LANE_QUEUES[adzerkpromote.BULK_LANE]
+
+    def sweep(name, force):
+        fake.reset_calls()
+        del latencies[:]
+        start = time.time()
+        adzerkpromote.make_adzerk_promotions(force=force)
+        queued = fake_reddit.queue_length(bulk_queue)
+        adzerkpromote.process_adzerk(lane=adzerkpromote.BULK_LANE)
+        elapsed = time.time() - start
+        calls = fake.total_calls()
+        print('%-6s sweep: %d msgs in %.2fs, %.1f msgs/s, %.1f calls/msg' % (
+            name, queued, elapsed, queued / elapsed,
+            float(calls) / max(1, queued)))
+        report_latency('%s message' % name, latencies)
+
+    sweep('cold', force=False)
+    sweep('warm', force=False)
+    sweep('forced', force=True)
+    adzerkpromote.handle_adzerk_message = handle_adzerk_message
+
+    # nothing changed since the sweeps, so only the bulk listings are made
+    fake.reset_calls()
+    start = time.time()
+    adzerkpromote.reconcile_adzerk_promotions()
+    elapsed = time.time() - start
+    print('reconcile: %d campaigns in %.2fs, %d calls (%s)' % (
+        args.campaigns, elapsed, fake.total_calls(),
+        ', '.join('%s: %d' % item for item in sorted(fake.calls.items()))))
+
+    latencies = []
+
+    def request(i):
+        keywords = ['sr%d' % (i % args.keyword_sets)]
+        timed(latencies, adzerkpromote.adzerk_request, keywords)
+
+    pool = workers.get_pool('bench', args.concurrency)
+    if pool is None:
+        for i in xrange(args.requests):
+            request(i)
+    else:
+        pending = [pool.apply_async(request, i)
+                   for i in xrange(args.requests)]
+        for async_result in pending:
+            async_result.get()
+    workers.close_pools()
+    adzerk_api.set_transport(None)
+    fake.stop()
+    report_latency('adzerk_request', latencies)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('suite', choices=['api', 'plugin'])
+    parser.add_argument('--objects', type=int, default=200,
+                        help='campaigns to create (api suite)')
+    parser.add_argument('--campaigns', type=int, default=100,
+                        help='live campaigns to sync (plugin suite)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='decision requests to make')
+    parser.add_argument('--keyword-sets', type=int, default=50,
+                        help='distinct keyword sets targeted (plugin suite)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='az_consumer_batch_size (plugin suite)')
+    parser.add_argument('--link-workers', type=int, default=1,
+                        help='az_consumer_link_workers (plugin suite)')
+    parser.add_argument('--stage-workers', type=int, default=1,
+                        help='az_consumer_stage_workers (plugin suite)')
+    parser.add_argument('--optimistic', action='store_true',
+                        help='az_optimistic_locking (plugin suite)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=None)
+    parser.add_argument('--fill-rate', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    if args.suite == 'api':
+        run_api(args)
+    else:
+        run_plugin(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Micro-benchmark for adzerk_api model objects.
+
+Reports the memory used per object and the time to hydrate a Campaign
+with many Flights and CreativeMaps from a parsed API response. Run it on
+two revisions to compare them:
+
+    python benchmarks/bench_models.py --flights 50 --repeat 200
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'reddit_adzerk'))
+import adzerk_api
+
+
+def flight_item(Id, campaign_id, num_maps):
+    return {
+        'Id': Id,
+        'Name': 't6_%s' % Id,
+        'StartDate': '/Date(1420099200000)/',
+        'EndDate': '/Date(1420185600000)/',
+        'Price': 1.25,
+        'OptionType': 1,
+        'Impressions': 10500,
+        'IsUnlimited': False,
+        'IsFullSpeed': False,
+        'Keywords': 'pics',
+        'CampaignId': campaign_id,
+        'PriorityId': 1,
+        'IsDeleted': False,
+        'IsActive': True,
+        'GoalType': 1,
+        'RateType': 2,
+        'IsFreqCap': None,
+        'CreativeMaps': [{
+            'Id': Id * 100 + i,
+            'SizeOverride': False,
+            'CampaignId': campaign_id,
+            'PublisherAccountId': 1,
+            'IsDeleted': False,
+            'Percentage': 100,
+            'Iframe': False,
+            'Creative': {'Id': Id * 100 + i},
+            'IsActive': True,
+            'FlightId': Id,
+            'Impressions': 100,
+            'DistributionType': 2,
+        } for i in xrange(num_maps)],
+    }
+
+
+def campaign_item(num_flights, num_maps):
+    return {
+        'Id': 1,
+        'Name': 't3_1',
+        'AdvertiserId': 1,
+        'StartDate': '/Date(1420099200000)/',
+        'IsDeleted': False,
+        'IsActive': True,
+        'Price': 0,
+        'Flights': [flight_item(i, 1, num_maps)
+                    for i in xrange(1, num_flights + 1)],
+    }
+
+
+def sizeof(thing, seen=None):
+    """Approximate deep size in bytes of a model object graph."""
+    seen = seen if seen is not None else set()
+    if id(thing) in seen:
+        return 0
+    seen.add(id(thing))
+
+    size = sys.getsizeof(thing)
+    if isinstance(thing, dict):
+        size += sum(sizeof(v, seen) for v in thing.itervalues())
+    elif isinstance(thing, (list, tuple)):
+        size += sum(sizeof(v, seen) for v in thing)
+    elif type(thing).__module__ == 'adzerk_api':
+        if hasattr(thing, '__dict__'):
+            size += sizeof(thing.__dict__, seen)
+        for klass in type(thing).__mro__:
+            for slot in getattr(klass, '__slots__', ()):
+                if hasattr(thing, slot):
+                    size += sizeof(getattr(thing, slot), seen)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--flights', type=int, default=50)
+    parser.add_argument('--maps', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    payload = json.dumps(campaign_item(args.flights, args.maps))
+    items = [json.loads(payload) for i in xrange(args.repeat)]
+
+    start = time.time()
+    campaigns = [adzerk_api.Campaign._from_item(item) for item in items]
+    elapsed = time.time() - start
+    graph_size = sizeof(campaigns[0])
+
+    # reading the nested collections forces any deferred hydration
+    start = time.time()
+    for campaign in campaigns:
+        for flight in campaign.Flights:
+            for cfmap in flight.CreativeMaps:
+                cfmap.Creative
+    elapsed_nested = time.time() - start
+
+    num_objects = 1 + args.flights * (1 + 2 * args.maps)
+    full_size = sizeof(campaigns[0])
+    flight_size = sizeof(campaigns[0].Flights[0]) if args.flights else 0
+    total = elapsed + elapsed_nested
+
+    print('objects per campaign:   %d' % num_objects)
+    print('campaign graph size:    %d bytes' % graph_size)
+    print('  after reading nested: %d bytes' % full_size)
+    print('bytes per flight:       %d' % flight_size)
+    print('hydrate campaign:       %.3f ms' % (elapsed * 1000 / args.repeat))
+    print('  plus reading nested:  %.3f ms' % (total * 1000 / args.repeat))
+    print('construct per object:   %.2f us' % (
+        total * 1e6 / (args.repeat * num_objects)))
+
+
+if __name__ == '__main__':
+    main()
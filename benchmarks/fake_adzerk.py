@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+"""Local stand-in for the Adzerk management and decision APIs.
+
+Implements enough of api.adzerk.net/v1 (campaign, flight, creative,
+flight/<id>/creative and the other simple resources, plus their paged
+list endpoints) and engine.adzerk.net/api/v2 for the plugin to run
+against it. Objects live in memory. Latency, errors and rate limiting
+can be injected to see how the plugin behaves when Adzerk is slow or
+failing.
+
+Run it standalone:
+
+    python benchmarks/fake_adzerk.py --port 8089 --latency-ms 20
+
+and point the plugin at it by setting adzerk_api.Base._base_url to
+http://127.0.0.1:8089/v1 and adzerkpromote.ADZERK_ENGINE_URL to
+http://127.0.0.1:8089/api/v2, or start it in process with
+FakeAdzerk(...).start().
+
+"""
+
+import argparse
+from collections import defaultdict
+import itertools
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+
+RESOURCES = ('advertiser', 'campaign', 'channel', 'creative', 'flight',
+             'priority', 'publisher', 'site', 'zone')
+
+ROUTES = [
+    ('decision', re.compile(r'^/api/v2/?$')),
+    ('map_list', re.compile(r'^/v1/flight/(\d+)/creatives$')),
+    ('map', re.compile(r'^/v1/flight/(\d+)/creative(?:/(\d+))?$')),
+    ('creative_list', re.compile(r'^/v1/advertiser/(\d+)/creatives$')),
+    ('resource', re.compile(r'^/v1/(%s)(?:/(\d+))?$' % '|'.join(RESOURCES))),
+]
+
+
+class RateLimiter(object):
+    """Allow rate requests per second with bursts of up to rate."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeAdzerk(object):
+    """In-memory Adzerk with injectable faults.
+
+    latency_ms is added to every request (uniformly jittered by
+    jitter_ms), error_rate is the fraction of requests failed with a 500,
+    rate_limit the requests per second allowed before returning 429s with
+    a Retry-After header, and fill_rate the fraction of decision requests
+    that get ads.
+
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0,
+                 error_rate=0, rate_limit=None, fill_rate=1.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.fill_rate = fill_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.objects = defaultdict(dict)
+        self.calls = defaultdict(int)
+        self.server = _Server((host, port), _Handler)
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    @property
+    def api_url(self):
+        return self.url + '/v1'
+
+    @property
+    def engine_url(self):
+        return self.url + '/api/v2'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_connections()
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def total_calls(self, prefix=''):
+        with self.lock:
+            return sum(count for key, count in self.calls.items()
+                       if key.startswith(prefix))
+
+    # objects
+
+    def _create(self, resource, item, **extra):
+        with self.lock:
+            item = dict(item, **extra)
+            item['Id'] = next(self.ids)
+            item.setdefault('IsDeleted', False)
+            if resource == 'campaign':
+                item['Flights'] = [self.objects['flight'].get(f.get('Id'), f)
+                                   for f in item.get('Flights') or []]
+            self.objects[resource][item['Id']] = item
+            return item
+
+    def _update(self, resource, Id, item):
+        with self.lock:
+            if Id not in self.objects[resource]:
+                return None
+            existing = self.objects[resource][Id]
+            existing.update(item)
+            existing['Id'] = Id
+            return existing
+
+    def _get(self, resource, Id):
+        with self.lock:
+            return self.objects[resource].get(Id)
+
+    def _list(self, resource, match=None):
+        with self.lock:
+            objects = sorted(self.objects[resource].items())
+            items = [item for Id, item in objects
+                     if match is None or match(item)]
+        return items
+
+    def _decisions(self, request):
+        keywords = request.get('keywords') or []
+        with self.lock:
+            creatives = list(self.objects['creative'].values())
+
+        decisions = {}
+        for placement in request.get('placements', []):
+            div = placement['divName']
+            if not creatives or self.random.random() >= self.fill_rate:
+                decisions[div] = None
+                continue
+
+            creative = self.random.choice(creatives)
+            title = creative.get('Title') or 't3_0-t8_0'
+            link, _, campaign = title.partition('-')
+            body = {
+                'link': link,
+                'campaign': campaign,
+                'target': keywords[0] if keywords else 'all',
+            }
+            decisions[div] = {
+                'adId': creative['Id'],
+                'creativeId': creative['Id'],
+                'impressionUrl': '%s/i.gif?c=%s' % (self.url, creative['Id']),
+                'clickUrl': '%s/r?c=%s' % (self.url, creative['Id']),
+                'contents': [{'type': 'raw', 'body': json.dumps(body)}],
+            }
+        return {'user': {'key': 'fake'}, 'decisions': decisions}
+
+    # request handling
+
+    def handle(self, method, path, query, body):
+        """Return (status, headers, response object) for a request."""
+        delay = self.latency_ms + self.random.uniform(-1, 1) * self.jitter_ms
+        if delay > 0:
+            time.sleep(delay / 1000.)
+
+        route, match = None, None
+        for route, pattern in ROUTES:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            return 404, {}, {'message': 'no route for %s' % path}
+
+        with self.lock:
+            self.calls['%s %s' % (method, route)] += 1
+
+        if self.rate_limiter and not self.rate_limiter.allow():
+            return 429, {'Retry-After': '1'}, {'message': 'rate limited'}
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, {}, {'message': 'injected error'}
+
+        try:
+            return getattr(self, '_handle_' + route)(method, match, query,
+                                                     body)
+        except (KeyError, ValueError) as e:
+            return 400, {}, {'message': 'bad request: %s' % e}
+
+    def _form_item(self, body):
+        # the plugin posts a single form field holding raw (unquoted) JSON
+        name, _, value = body.partition('=')
+        return json.loads(value)
+
+    def _page(self, items, query):
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('pageSize', ['500'])[0])
+        total_pages = max(1, (len(items) + page_size - 1) // page_size)
+        start = (page - 1) * page_size
+        return {
+            'page': page,
+            'pageSize': page_size,
+            'totalPages': total_pages,
+            'totalItems': len(items),
+            'items': items[start:start + page_size],
+        }
+
+    def _handle_resource(self, method, match, query, body):
+        resource, Id = match.group(1), match.group(2)
+        if Id is None:
+            if method == 'GET':
+                return 200, {}, self._page(self._list(resource), query)
+            if method == 'POST':
+                return 200, {}, self._create(resource, self._form_item(body))
+        else:
+            Id = int(Id)
+            if method == 'GET':
+                item = self._get(resource, Id)
+            elif method == 'PUT':
+                item = self._update(resource, Id, self._form_item(body))
+            else:
+                return 405, {}, {'message': 'method not allowed'}
+            if item is None:
+                return 404, {}, {'message': 'not found'}
+            return 200, {}, item
+        return 405, {}, {'message': 'method not allowed'}
+
+    def _handle_map(self, method, match, query, body):
+        flight_id, Id = int(match.group(1)), match.group(2)
+        if Id is None and method == 'POST':
+            item = self._form_item(body)
+            return 200, {}, self._create('cfmap', item, FlightId=flight_id)
+        elif Id is not None and method in ('GET', 'PUT'):
+            if method == 'GET':
+                item = self._get('cfmap', int(Id))
+            else:
+                item = self._update('cfmap', int(Id), self._form_item(body))
+            if item is None or item.get('FlightId') != flight_id:
+                return 404, {}, {'message': 'not found'}
+            return 200, {}, item
+        return 405, {}, {'message': 'method not allowed'}
+
+    def _handle_map_list(self, method, match, query, body):
+        flight_id = int(match.group(1))
+        items = self._list('cfmap', lambda i: i.get('FlightId') == flight_id)
+        return 200, {}, self._page(items, query)
+
+    def _handle_creative_list(self, method, match, query, body):
+        advertiser_id = int(match.group(1))
+        items = self._list('creative',
+                           lambda i: i.get('AdvertiserId') == advertiser_id)
+        return 200, {}, self._page(items, query)
+
+    def _handle_decision(self, method, match, query, body):
+        if method != 'POST':
+            return 405, {}, {'message': 'method not allowed'}
+        return 200, {}, self._decisions(json.loads(body))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, *a, **kw):
+        HTTPServer.__init__(self, *a, **kw)
+        # handler thread of each open connection
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self.connections_lock:
+            self.connections[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self, timeout=5):
+        """Close idle keep-alive connections and wait for their threads.
+
+        Otherwise their handlers are still blocked reading the next request
+        when the interpreter exits, and print tracebacks as it tears down.
+
+        """
+
+        with self.connections_lock:
+            connections = list(self.connections.items())
+        for request, thread in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for request, thread in connections:
+            thread.join(timeout)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like the real API, so connection pooling is exercised
+    protocol_version = 'HTTP/1.1'
+    # write each response in one go, unbuffered headers and body in
+    # separate packets stall on delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if not isinstance(body, str):
+            body = body.decode('utf-8')
+        query = parse_qs(url.query)
+
+        status, headers, obj = self.server.fake.handle(
+            self.command, url.path, query, body)
+        payload = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, *a):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit', type=float, default=None)
+    parser.add_argument('--fill-rate', type=float, default=1.0)
+    args = parser.parse_args()
+
+    fake = FakeAdzerk(args.host, args.port, latency_ms=args.latency_ms,
+                      jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                      rate_limit=args.rate_limit, fill_rate=args.fill_rate)
+    print('fake adzerk listening on %s' % fake.url)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
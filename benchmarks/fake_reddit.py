@@ -0,0 +1,415 @@
+"""In-memory stand-ins for the parts of reddit the plugin's sync path uses.
+
+bench_e2e's plugin suite runs the real adzerkpromote code (the daily
+sweep, the adzerk_q consumers, _update_adzerk and adzerk_request) on a
+box without reddit. install() registers stub r2 modules so adzerkpromote
+can be imported. Links and campaigns live in memory and _commit only
+counts, PromotionLog entries are kept in a list, amqp queues are deques
+and Globals.cache stands in for memcache, so nothing is written to a
+database, memcache or a broker.
+
+"""
+
+import calendar
+from collections import defaultdict, deque
+import datetime
+import itertools
+import logging
+import sys
+import threading
+import types
+
+
+# g
+
+
+class Timer(object):
+    def start(self):
+        pass
+
+    def stop(self, subname='total'):
+        pass
+
+    def send(self, subname, delta):
+        pass
+
+
+class Stats(object):
+    """Discards metrics, standing in for r2's g.stats."""
+
+    def simple_event(self, name, delta=1):
+        pass
+
+    def get_timer(self, name):
+        return Timer()
+
+    def amqp_processor(self, queue):
+        return lambda fn: fn
+
+
+class Cache(object):
+    """Thread safe dict standing in for memcache (g.cache)."""
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, val, time=0):
+        with self.lock:
+            self.data[key] = val
+        return True
+
+    def add(self, key, val, time=0):
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = val
+        return True
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data[key] += delta
+            return self.data[key]
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def get_multi(self, keys, prefix=''):
+        with self.lock:
+            return {key: self.data[prefix + key] for key in keys
+                    if prefix + key in self.data}
+
+    def set_multi(self, mapping, prefix='', time=0):
+        with self.lock:
+            for key, val in mapping.items():
+                self.data[prefix + key] = val
+
+
+class Globals(object):
+    """Stands in for pylons' g, with in-process locks and cache."""
+
+    az_selfserve_key = 'bench'
+    az_selfserve_advertiser_id = 1
+    az_selfserve_network_id = 1
+    az_selfserve_site_id = 1
+    az_selfserve_ad_type = 5
+    az_selfserve_priority_id = 1
+    az_selfserve_num_request = 1
+    tz = None
+
+    def __init__(self, config):
+        self.config = config
+        self.stats = Stats()
+        self.cache = Cache()
+        self.log = logging.getLogger('fake_reddit')
+        self.locks = defaultdict(threading.Lock)
+        self.locks_lock = threading.Lock()
+
+    def make_lock(self, group, name):
+        with self.locks_lock:
+            return self.locks[(group, name)]
+
+    def reset_caches(self):
+        pass
+
+
+# models
+
+
+class Thing(object):
+    """In-memory r2 Thing, _commit counts the writes it would make."""
+
+    _type_prefix = None
+    _things = None
+    _ids = itertools.count(1)
+
+    def __init__(self, **attrs):
+        self._id = next(Thing._ids)
+        self._deleted = False
+        self._commits = 0
+        for attr, val in attrs.items():
+            setattr(self, attr, val)
+        self._things[self._id] = self
+
+    @property
+    def _fullname(self):
+        return '%s_%d' % (self._type_prefix, self._id)
+
+    def _commit(self):
+        self._commits += 1
+
+    @classmethod
+    def _byID(cls, ids, data=False, return_dict=True):
+        if isinstance(ids, (list, tuple, set)):
+            return {Id: cls._things[Id] for Id in ids}
+        return cls._things[ids]
+
+    @classmethod
+    def _by_fullname(cls, names, data=False, return_dict=True):
+        if isinstance(names, basestring):
+            return cls._byID(int(names.split('_')[1]))
+        return {name: cls._byID(int(name.split('_')[1])) for name in names}
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self._fullname)
+
+
+class Account(Thing):
+    _type_prefix = 't2'
+    _things = {}
+
+
+class Link(Thing):
+    _type_prefix = 't3'
+    _things = {}
+
+
+class PromoCampaign(Thing):
+    _type_prefix = 't8'
+    _things = {}
+
+
+class PromotionLog(object):
+    entries = []
+
+    @classmethod
+    def add(cls, link, text):
+        cls.entries.append((link._fullname, text))
+
+
+class _TransactionColumn(object):
+    @staticmethod
+    def in_(values):
+        return list(values)
+
+
+class _BidQuery(object):
+    def filter(self, trans_ids):
+        # every campaign's trans_id is its own _id
+        return [Bid(trans_id, trans_id) for trans_id in trans_ids]
+
+
+class Bid(object):
+    """Bids for every campaign, all of them charged."""
+
+    transaction = _TransactionColumn()
+
+    def __init__(self, transaction, campaign):
+        self.transaction = transaction
+        self.campaign = campaign
+
+    def is_charged(self):
+        return True
+
+    @classmethod
+    def query(cls):
+        return _BidQuery()
+
+
+class TargetedImpressionsByCodename(object):
+    """No campaign has delivered any impressions."""
+
+    @classmethod
+    def campaign_history(cls, codenames, start, end):
+        return []
+
+
+class Frontpage(object):
+    name = ' reddit.com'
+
+
+class Unavailable(object):
+    """Placeholder for the parts of r2 only the promo controller uses."""
+
+    def __init__(self, *a, **kw):
+        pass
+
+
+def make_campaigns(num_campaigns, keyword_sets=50):
+    """Create num_campaigns live CPM campaigns, each on its own link."""
+    author = Account(name='bench')
+    start = datetime.datetime(2015, 1, 1)
+    campaigns = []
+    for i in xrange(num_campaigns):
+        link = Link(author_id=author._id)
+        campaign = PromoCampaign(
+            link_id=link._id,
+            start_date=start,
+            end_date=start + datetime.timedelta(days=7),
+            sr_name='sr%d' % (i % keyword_sets),
+            cpm=100,
+            impressions=10000,
+        )
+        campaign.trans_id = campaign._id
+        campaigns.append((link, campaign))
+    return campaigns
+
+
+# r2.lib.promote
+
+
+def accepted_campaigns(offset=0):
+    return [(Link._things[campaign.link_id], campaign, 1.)
+            for Id, campaign in sorted(PromoCampaign._things.items())
+            if not campaign._deleted]
+
+
+def is_accepted(link):
+    return not link._deleted
+
+
+def get_traffic_dates(campaign):
+    return campaign.start_date, campaign.end_date
+
+
+# r2.lib.amqp
+
+
+class Message(object):
+    def __init__(self, body):
+        self.body = body
+        self.channel = None
+
+
+queues = defaultdict(deque)
+queues_lock = threading.Lock()
+
+
+def add_item(queue, body):
+    with queues_lock:
+        queues[queue].append(body)
+
+
+def _take(queue, limit):
+    with queues_lock:
+        pending = queues[queue]
+        return [Message(pending.popleft())
+                for i in xrange(min(limit, len(pending)))]
+
+
+def consume_items(queue_names, callback, verbose=True):
+    """Call callback with each queued message, returning once all are done."""
+    if isinstance(queue_names, basestring):
+        queue_names = [queue_names]
+    for queue in queue_names:
+        while True:
+            msgs = _take(queue, 1)
+            if not msgs:
+                break
+            callback(msgs[0])
+
+
+def handle_items(queue, callback, limit=1, sleep_time=1, verbose=True,
+                 drain=False):
+    """Call callback with batches of queued messages until there are none."""
+    while True:
+        msgs = _take(queue, limit)
+        if not msgs:
+            return
+        callback(msgs, None)
+
+
+def queue_length(queue):
+    with queues_lock:
+        return len(queues[queue])
+
+
+# the r2 modules adzerkpromote imports
+
+
+def _epoch_seconds(date):
+    return calendar.timegm(date.utctimetuple())
+
+
+def _force_utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return str(text)
+
+
+class HookRegistrar(object):
+    def on(self, name):
+        return lambda fn: fn
+
+    def register_all(self):
+        pass
+
+
+def validate(*a, **kw):
+    return lambda fn: fn
+
+
+class ApiController(object):
+    pass
+
+
+def modules():
+    return {
+        'r2': {},
+        'r2.controllers': {
+            'add_controller': lambda controller: controller,
+        },
+        'r2.controllers.api': {'ApiController': ApiController},
+        'r2.lib': {},
+        'r2.lib.amqp': {
+            'add_item': add_item,
+            'consume_items': consume_items,
+            'handle_items': handle_items,
+        },
+        'r2.lib.organic': {},
+        'r2.lib.promote': {
+            'timezone_offset': datetime.timedelta(0),
+            'accepted_campaigns': accepted_campaigns,
+            'is_accepted': is_accepted,
+            'get_traffic_dates': get_traffic_dates,
+        },
+        'r2.lib.db': {},
+        'r2.lib.db.sorts': {'epoch_seconds': _epoch_seconds},
+        'r2.lib.filters': {
+            'spaceCompress': lambda text: text,
+            '_force_utf8': _force_utf8,
+        },
+        'r2.lib.pages': {},
+        'r2.lib.pages.things': {'default_thing_wrapper': Unavailable},
+        'r2.lib.template_helpers': {'replace_render': Unavailable},
+        'r2.lib.hooks': {'HookRegistrar': HookRegistrar},
+        'r2.lib.validator': {'validate': validate, 'VPrintable': Unavailable},
+        'r2.models': {
+            'Account': Account,
+            'Bid': Bid,
+            'CampaignBuilder': Unavailable,
+            'FakeSubreddit': Unavailable,
+            'Frontpage': Frontpage,
+            'Link': Link,
+            'LinkListing': Unavailable,
+            'PromoCampaign': PromoCampaign,
+            'PromotionLog': PromotionLog,
+            'Subreddit': Unavailable,
+        },
+        'r2.models.traffic': {
+            'TargetedImpressionsByCodename': TargetedImpressionsByCodename,
+        },
+    }
+
+
+def install():
+    """Register the stub r2 modules in sys.modules."""
+    if 'r2' in sys.modules:
+        raise RuntimeError('r2 is already imported, fake_reddit must run '
+                           'outside of reddit')
+
+    for name, attrs in sorted(modules().items()):
+        module = types.ModuleType(name)
+        module.__path__ = []
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
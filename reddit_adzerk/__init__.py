@@ -16,6 +16,45 @@ class Adzerk(Plugin):
             'az_selfserve_network_id',
             'az_selfserve_ad_type',
             'az_selfserve_num_request',
+            'az_api_pool_connections',
+            'az_api_pool_maxsize',
+            'az_api_page_size',
+            'az_drift_check_interval',
+            'az_consumer_batch_size',
+            'az_consumer_batch_wait_ms',
+            'az_consumer_link_workers',
+            'az_consumer_stage_workers',
+            'az_request_breaker_threshold',
+            'az_no_promo_cache_ttl',
+            'az_no_promo_cache_size',
+            'az_singleflight_window_ms',
+            'az_singleflight_max_shared',
+            'az_overdelivery_interval',
+            'az_consumer_shard_instances',
+            'az_consumer_bulk_shard_instances',
+            'az_api_burst',
+            'az_api_max_retries',
+            'az_mirror_ttl',
+            'az_mirror_size',
+            'az_mirror_max_staleness',
+        ],
+        ConfigValue.float: [
+            'az_api_connect_timeout',
+            'az_api_read_timeout',
+            'az_request_timeout',
+            'az_request_breaker_cooloff',
+            'az_replay_latency_scale',
+            'az_api_rate_limit',
+            'az_api_backoff_base',
+            'az_api_backoff_max',
+        ],
+        ConfigValue.bool: [
+            'az_api_pool_block',
+            'az_no_promo_cache_memcache',
+            'az_reconcile_daily',
+            'az_optimistic_locking',
+            'az_api_rate_limit_memcache',
+            'az_mirror_memcache',
         ],
     }
 
@@ -30,9 +69,16 @@ class Adzerk(Plugin):
 
     def declare_queues(self, queues):
         from r2.config.queues import MessageQueue
+        from sharding import shard_queues
         queues.declare({
             "adzerk_q": MessageQueue(bind_to_self=True),
+            "adzerk_bulk_q": MessageQueue(bind_to_self=True),
         })
+        for queue in ("adzerk_q", "adzerk_bulk_q"):
+            queues.declare({
+                shard: MessageQueue(bind_to_self=True)
+                for shard in shard_queues(queue)
+            })
 
     def load_controllers(self):
         # replace the standard Ads view with an Adzerk specific one.
@@ -1,24 +1,279 @@
+from contextlib import contextmanager
+import cookielib
 import json
 import requests
 import sys
+import threading
+import time
 
 from pylons import g
+from requests.adapters import HTTPAdapter
+
+import instrument
+import jsonstream
+import mirror
+import ratelimit
+import recording
 
 
 class AdzerkError(Exception): pass
 class NotFound(AdzerkError): pass
 
 
-def handle_response(response):
+def check_response(response):
     if not (200 <= response.status_code <= 299):
         raise AdzerkError('response %s' % response.status_code)
+
+
+def handle_response(response):
+    check_response(response)
     try:
         return json.loads(response.text)
     except ValueError:
         raise AdzerkError('bad response')
 
 
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def iter_response_items(response, meta=None):
+    """Decode the items of a list response incrementally as it arrives."""
+    check_response(response)
+    chunks = response.iter_content(STREAM_CHUNK_SIZE)
+    try:
+        for item in jsonstream.iter_array(chunks, 'items', meta):
+            yield item
+    except ValueError:
+        raise AdzerkError('bad response')
+
+
+class NoCookies(cookielib.CookiePolicy):
+    """Cookie policy that never stores or sends a cookie."""
+
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+    def path_return_ok(self, path, request):
+        return False
+
+
+class Transport(object):
+    """Connection-pooled, keep-alive HTTP transport for the management API.
+
+    A single instance is shared by every Base subclass in the process so
+    consecutive calls (and consecutive queue messages) reuse connections
+    instead of paying a new handshake each time. requests.Session and the
+    underlying urllib3 pools are safe to share between threads.
+
+    Cookies are never kept, a cookie set in a response to one request
+    must not be sent with requests made for other users.
+
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=10, pool_block=True,
+                 connect_timeout=3.05, read_timeout=30):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.cookies.set_policy(NoCookies())
+        # pool_connections is the number of per-host pools kept around,
+        # pool_maxsize the number of connections kept open to each host
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, **kw):
+        config = dict(
+            pool_connections=g.config.get('az_api_pool_connections', 4),
+            pool_maxsize=g.config.get('az_api_pool_maxsize', 10),
+            pool_block=g.config.get('az_api_pool_block', True),
+            connect_timeout=g.config.get('az_api_connect_timeout', 3.05),
+            read_timeout=g.config.get('az_api_read_timeout', 30),
+        )
+        config.update(kw)
+        return cls(**config)
+
+    def request(self, method, url, **kw):
+        kw.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kw)
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_engine_transport = None
+_transport_lock = threading.Lock()
+
+
+def make_transport():
+    """Build the Transport configured for this process.
+
+    With az_replay_path set, requests are answered from a recording
+    instead of being made. Otherwise a pooled Transport is built, and if
+    az_record_path is set every exchange is also recorded to that file.
+
+    """
+
+    replay_path = g.config.get('az_replay_path')
+    if replay_path:
+        return recording.ReplayTransport.from_file(
+            replay_path,
+            mode=g.config.get('az_replay_mode', 'order'),
+            latency_scale=g.config.get('az_replay_latency_scale', 1.0),
+        )
+
+    transport = Transport.from_config()
+    record_path = g.config.get('az_record_path')
+    if record_path:
+        transport = recording.RecordingTransport(
+            transport, recording.Recorder(record_path))
+    return transport
+
+
+def get_transport():
+    """Return the process-wide Transport, creating it on first use."""
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = make_transport()
+    return _transport
+
+
+def make_engine_transport():
+    """Build the Transport for decision engine requests.
+
+    These are made on the page path, so the pool never blocks: when all
+    of its connections are busy an extra one is opened instead of waiting
+    for a free one without any timeout, which would bypass the latency
+    budget. Replaying and recording go through the process-wide Transport
+    so one file holds all the traffic.
+
+    """
+
+    transport = get_transport()
+    if isinstance(transport, recording.ReplayTransport):
+        return transport
+
+    engine_transport = Transport.from_config(pool_block=False)
+    if isinstance(transport, recording.RecordingTransport):
+        engine_transport = recording.RecordingTransport(engine_transport,
+                                                        transport.recorder)
+    return engine_transport
+
+
+def get_engine_transport():
+    """Return the process-wide decision engine Transport."""
+    global _engine_transport
+    if _engine_transport is None:
+        # make_engine_transport needs it, and _transport_lock isn't
+        # reentrant
+        get_transport()
+        with _transport_lock:
+            if _engine_transport is None:
+                _engine_transport = make_engine_transport()
+    return _engine_transport
+
+
+def set_transport(transport):
+    """Replace the process-wide Transport, closing the previous one.
+
+    The decision engine Transport is rebuilt from it on next use.
+
+    """
+
+    global _transport, _engine_transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+        engine_transport, _engine_transport = _engine_transport, None
+    for old in {previous, engine_transport}:
+        if old is not None and old is not transport:
+            old.close()
+
+
+class IdentityMap(object):
+    """Objects fetched or written during one unit of work, by (class, Id).
+
+    Within a unit of work each object is fetched from the API at most once;
+    objects returned by create and written by _send replace the cached copy
+    so later lookups see the state that was last pushed.
+
+    """
+
+    def __init__(self):
+        self._things = {}
+        self._lock = threading.Lock()
+
+    def get(self, cls, Id):
+        with self._lock:
+            return self._things.get((cls, Id))
+
+    def add(self, thing):
+        with self._lock:
+            self._things[(thing.__class__, thing.Id)] = thing
+
+    def discard(self, cls, Id):
+        with self._lock:
+            self._things.pop((cls, Id), None)
+
+    def __len__(self):
+        return len(self._things)
+
+
+_local = threading.local()
+
+
+def current_identity_map():
+    return getattr(_local, 'identity_map', None)
+
+
+@contextmanager
+def unit_of_work(identity_map=None):
+    """Share an IdentityMap between all API calls made in the block.
+
+    Nested blocks reuse the enclosing map. Passing an existing map lets
+    other threads join the same unit of work.
+
+    """
+
+    previous = current_identity_map()
+    if identity_map is None:
+        identity_map = previous or IdentityMap()
+    _local.identity_map = identity_map
+    try:
+        yield identity_map
+    finally:
+        _local.identity_map = previous
+
+
+def _remember(thing):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        identity_map.add(thing)
+    return thing
+
+
+def _recall(cls, Id):
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        return identity_map.get(cls, Id)
+
+
 class Stub(object):
+    __slots__ = ('Id',)
+
     def __init__(self, Id):
         self.Id = Id
 
@@ -48,19 +303,230 @@ class FieldSet(object):
             yield field_name
 
 
+class _RawItems(object):
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+
+class Nested(object):
+    """A field holding a list of nested model objects.
+
+    API responses are stored as the raw item dicts and only turned into
+    model objects the first time the field is read. Until then _to_item
+    serializes the raw items through the model without keeping the
+    objects, so they are sent with the same fields as once they're read.
+
+    """
+
+    def __init__(self, name, model):
+        self.slot = '_' + name
+        self.model = model  # name of the model class, may be defined later
+
+    @staticmethod
+    def raw(items):
+        return _RawItems(items or [])
+
+    def __get__(self, thing, cls=None):
+        if thing is None:
+            return self
+        val = getattr(thing, self.slot)
+        if isinstance(val, _RawItems):
+            model = globals()[self.model]
+            val = [model._from_item(dict(item)) for item in val.items]
+            setattr(thing, self.slot, val)
+        return val
+
+    def __set__(self, thing, val):
+        setattr(thing, self.slot, val)
+
+    def to_item(self, thing):
+        val = getattr(thing, self.slot)
+        if isinstance(val, _RawItems):
+            model = globals()[self.model]
+            return [model._from_item(dict(item))._to_item()
+                    for item in val.items]
+        elif val:
+            return [nested._to_item() for nested in val]
+        return val
+
+
+class ModelMeta(type):
+    """Generate compact, slot based storage for a model from its FieldSet.
+
+    Instances get one slot per field instead of a __dict__, so assigning an
+    unknown attribute fails without any Python level __setattr__. A field
+    that the class implements as a property is stored in a slot named
+    _<field>.
+
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        if '__slots__' not in attrs:
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(getattr(klass, '__slots__', ()))
+
+            names = ['Id', '_extra'] + sorted(attrs.get('_fields') or [])
+            slots = []
+            for slot in names:
+                if slot in attrs:
+                    slot = '_' + slot
+                if slot not in inherited:
+                    slots.append(slot)
+            attrs['__slots__'] = tuple(slots)
+        return type.__new__(mcs, name, bases, attrs)
+
+
 class Base(object):
+    __metaclass__ = ModelMeta
+
     _name = ''
     _base_url = 'http://api.adzerk.net/v1'
     _fields = FieldSet()
+    # whether get reads through the shared mirror of items
+    _mirrored = False
 
     @classmethod
     def _headers(cls):
         return {'X-Adzerk-ApiKey': g.az_selfserve_key,
                 'Content-Type': 'application/x-www-form-urlencoded'}
 
+    @classmethod
+    def _resource(cls):
+        """Name of the API resource for metrics, e.g. campaign."""
+        return cls._name
+
+    @classmethod
+    def _mirror_get(cls, Id, max_staleness=None):
+        az_mirror = mirror.get_mirror() if cls._mirrored else None
+        if az_mirror is not None:
+            return az_mirror.get(cls._resource(), Id, max_staleness)
+
+    @classmethod
+    def _mirror_put(cls, item):
+        az_mirror = mirror.get_mirror() if cls._mirrored else None
+        if az_mirror is not None:
+            az_mirror.put(cls._resource(), item['Id'], item)
+
+    @classmethod
+    def _mirror_discard(cls, Id):
+        az_mirror = mirror.get_mirror() if cls._mirrored else None
+        if az_mirror is not None:
+            az_mirror.discard(cls._resource(), Id)
+
+    @classmethod
+    def _request(cls, method, url, data=None, **kw):
+        """Make a rate limited API call, retrying it if it's rejected.
+
+        Calls wait for the process-wide token bucket (az_api_rate_limit).
+        429 and 503 responses slow the bucket down and the call is retried
+        up to az_api_max_retries times after an exponential backoff, or
+        after the Retry-After the API asked for. Creates are only retried
+        after a 429, see ratelimit.is_retryable.
+
+        """
+
+        bucket = ratelimit.get_bucket()
+        max_retries = g.config.get('az_api_max_retries', 4)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                waited = bucket.acquire()
+                if waited:
+                    instrument.add_time('ratelimit.wait', waited)
+
+            response = cls._request_once(method, url, data=data, **kw)
+            status = response.status_code
+            if status not in ratelimit.RETRY_STATUSES:
+                if bucket is not None:
+                    bucket.relax()
+                return response
+
+            if bucket is not None:
+                bucket.throttle()
+            if not ratelimit.is_retryable(method, status):
+                return response
+            if attempt >= max_retries:
+                g.stats.simple_event('adzerk_api.retry.exhausted')
+                return response
+
+            delay = ratelimit.backoff_delay(
+                attempt, response,
+                base=g.config.get('az_api_backoff_base', 0.5),
+                cap=g.config.get('az_api_backoff_max', 30),
+            )
+            response.close()
+            g.stats.simple_event('adzerk_api.retry.%s' % status)
+            instrument.add_time('ratelimit.backoff', delay)
+            time.sleep(delay)
+            attempt += 1
+
+    @classmethod
+    def _request_once(cls, method, url, data=None, **kw):
+        resource = cls._resource()
+        request_bytes = len(data) if data else 0
+        start = time.time()
+        try:
+            response = get_transport().request(
+                method, url, headers=cls._headers(), data=data, **kw)
+        except requests.exceptions.Timeout:
+            instrument.record_call('adzerk_api', resource, method,
+                                   time.time() - start, 'timeout',
+                                   request_bytes)
+            raise
+        except requests.exceptions.RequestException:
+            instrument.record_call('adzerk_api', resource, method,
+                                   time.time() - start, 'error',
+                                   request_bytes)
+            raise
+
+        # streamed responses are timed up to their headers
+        response_bytes = instrument.response_size(
+            response, streamed=kw.get('stream', False))
+        instrument.record_call('adzerk_api', resource, method,
+                               time.time() - start, response.status_code,
+                               request_bytes, response_bytes)
+        return response
+
+    @classmethod
+    def _iter_pages(cls, url, page_size=None):
+        """Yield model objects from every page of a list endpoint.
+
+        Pages are requested one at a time and decoded as they stream in, so
+        only one page's connection and one item at a time are held.
+
+        """
+
+        page_size = page_size or g.config.get('az_api_page_size', 500)
+        page = 1
+        while True:
+            params = {'page': page, 'pageSize': page_size}
+            response = cls._request('GET', url, params=params, stream=True)
+            meta = {}
+            count = 0
+            try:
+                for item in iter_response_items(response, meta):
+                    count += 1
+                    yield cls._from_item(item)
+            finally:
+                response.close()
+
+            total_pages = meta.get('totalPages')
+            if total_pages is not None:
+                if page >= total_pages:
+                    return
+            elif count < page_size:
+                return
+            page += 1
+
     def __init__(self, Id, _is_response=False, **attr):
         self.Id = Id
-        missing = self._fields.to_set() - set(attr.keys())
+        self._extra = None
+        fields = self._fields
+        missing = fields.to_set() - set(attr.keys())
         if missing:
             missing = ', '.join(missing)
             msg = 'missing required attributes: %s' % missing
@@ -70,16 +536,22 @@ class Base(object):
                 raise ValueError(msg)
 
         for attr, val in attr.iteritems():
-            self.__setattr__(attr, val, fail_on_unrecognized=(not _is_response))
-
-    def __setattr__(self, attr, val, fail_on_unrecognized=True):
-        if attr not in self._fields and attr != 'Id':
-            msg = 'unrecognized attribute: %s' % attr
-            if fail_on_unrecognized:
-                raise ValueError(msg)
+            if attr in fields.fields:
+                setattr(self, attr, val)
+            elif _is_response:
+                # keep unrecognized attributes from the API around, they
+                # are never sent back
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[attr] = val
             else:
-                pass
-        object.__setattr__(self, attr, val)
+                raise ValueError('unrecognized attribute: %s' % attr)
+
+    def __getattr__(self, attr):
+        # only called when regular lookup fails, e.g. for an unset field
+        if attr != '_extra' and self._extra and attr in self._extra:
+            return self._extra[attr]
+        raise AttributeError(attr)
 
     @classmethod
     def _from_item(cls, item):
@@ -91,8 +563,15 @@ class Base(object):
         item = {}
         if self.Id:
             item['Id'] = self.Id
+        cls = type(self)
         for attr in self._fields:
-            if hasattr(self, attr):
+            nested = getattr(cls, attr, None)
+            if isinstance(nested, Nested):
+                try:
+                    item[attr] = nested.to_item(self)
+                except AttributeError:
+                    pass
+            elif hasattr(self, attr):
                 item[attr] = getattr(self, attr)
         return item
 
@@ -100,34 +579,58 @@ class Base(object):
         return '%s=%s' % (self._name, json.dumps(self._to_item()))
 
     @classmethod
-    def list(cls):
+    def iterate(cls, page_size=None):
         url = '/'.join([cls._base_url, cls._name])
-        response = requests.get(url, headers=cls._headers())
-        content = handle_response(response)
-        items = content.get('items')
-        if items:
-            return [cls._from_item(item) for item in items]
+        return cls._iter_pages(url, page_size)
+
+    @classmethod
+    def list(cls):
+        things = list(cls.iterate())
+        if things:
+            return things
 
     @classmethod
     def create(cls, **attr):
         url = '/'.join([cls._base_url, cls._name])
         thing = cls(None, **attr)
         data = thing._to_data()
-        response = requests.post(url, headers=cls._headers(), data=data)
+        response = cls._request('POST', url, data=data)
         item = handle_response(response)
-        return cls._from_item(item)
+        cls._mirror_put(item)
+        return _remember(cls._from_item(item))
 
     def _send(self):
         url = '/'.join([self._base_url, self._name, str(self.Id)])
         data = self._to_data()
-        response = requests.put(url, headers=self._headers(), data=data)
+        try:
+            response = self._request('PUT', url, data=data)
+            check_response(response)
+        except Exception:
+            # the remote state is unknown now
+            self._mirror_discard(self.Id)
+            raise
+        self._mirror_put(self._to_item())
+        _remember(self)
 
     @classmethod
-    def get(cls, Id):
-        url = '/'.join([cls._base_url, cls._name, str(Id)])
-        response = requests.get(url, headers=cls._headers())
-        item = handle_response(response)
-        return cls._from_item(item)
+    def get(cls, Id, max_staleness=None):
+        """Fetch an object, from the unit of work or mirror if it's there.
+
+        max_staleness (seconds) overrides az_mirror_max_staleness, 0
+        always fetches from the API.
+
+        """
+
+        thing = _recall(cls, Id)
+        if thing is not None:
+            return thing
+        item = cls._mirror_get(Id, max_staleness)
+        if item is None:
+            url = '/'.join([cls._base_url, cls._name, str(Id)])
+            response = cls._request('GET', url)
+            item = handle_response(response)
+            cls._mirror_put(item)
+        return _remember(cls._from_item(item))
 
 
 class Map(Base):
@@ -136,14 +639,20 @@ class Map(Base):
     child = None
 
     @classmethod
-    def list(cls, ParentId):
+    def _resource(cls):
+        return '%s_%s' % (cls.parent._name, cls.child._name)
+
+    @classmethod
+    def iterate(cls, ParentId, page_size=None):
         url = '/'.join([cls._base_url, cls.parent._name, str(ParentId),
                         cls.child._name + 's'])
-        response = requests.get(url, headers=cls._headers())
-        content = handle_response(response)
-        items = content.get('items')
-        if items:
-            return [cls._from_item(item) for item in items]
+        return cls._iter_pages(url, page_size)
+
+    @classmethod
+    def list(cls, ParentId):
+        things = list(cls.iterate(ParentId))
+        if things:
+            return things
 
     @classmethod
     def create(cls, ParentId, **attr):
@@ -151,24 +660,39 @@ class Map(Base):
                         cls.child._name])
         thing = cls(None, **attr)
         data = thing._to_data()
-        response = requests.post(url, headers=cls._headers(), data=data)
+        response = cls._request('POST', url, data=data)
         item = handle_response(response)
-        return cls._from_item(item)
+        cls._mirror_put(item)
+        return _remember(cls._from_item(item))
 
     def _send(self):
         url = '/'.join([self._base_url, self.parent._name,
                         str(getattr(self, self.parent_id_attr)),
                         self.child._name, str(self.Id)])
         data = self._to_data()
-        response = requests.put(url, headers=self._headers(), data=data)
+        try:
+            response = self._request('PUT', url, data=data)
+            check_response(response)
+        except Exception:
+            # the remote state is unknown now
+            self._mirror_discard(self.Id)
+            raise
+        self._mirror_put(self._to_item())
+        _remember(self)
 
     @classmethod
-    def get(cls, ParentId, Id):
-        url = '/'.join([cls._base_url, cls.parent._name, str(ParentId),
-                        cls.child._name, str(Id)])
-        response = requests.get(url, headers=cls._headers())
-        item = handle_response(response)
-        return cls._from_item(item)
+    def get(cls, ParentId, Id, max_staleness=None):
+        thing = _recall(cls, Id)
+        if thing is not None:
+            return thing
+        item = cls._mirror_get(Id, max_staleness)
+        if item is None:
+            url = '/'.join([cls._base_url, cls.parent._name, str(ParentId),
+                            cls.child._name, str(Id)])
+            response = cls._request('GET', url)
+            item = handle_response(response)
+            cls._mirror_put(item)
+        return _remember(cls._from_item(item))
 
 
 class Site(Base):
@@ -213,6 +737,7 @@ class Advertiser(Base):
 
 class Flight(Base):
     _name = 'flight'
+    _mirrored = True
     _fields = FieldSet(
         Field('Name'),
         Field('StartDate'),
@@ -254,25 +779,16 @@ class Flight(Base):
         Field('DeliveryStatus', optional=True),
     )
 
+    CreativeMaps = Nested('CreativeMaps', 'CreativeFlightMap')
+
     @classmethod
     def _from_item(cls, item):
         if not 'Name' in item:
             item['Name'] = ''   # not always included in response
-        if not 'CreativeMaps' in item or not item['CreativeMaps']:
-            item['CreativeMaps'] = []
+        item['CreativeMaps'] = Nested.raw(item.get('CreativeMaps'))
         thing = super(cls, cls)._from_item(item)
-        if hasattr(thing, 'CreativeMaps'):
-            thing.CreativeMaps = [CreativeFlightMap._from_item(item)
-                             for item in thing.CreativeMaps]
         return thing
 
-    def _to_item(self):
-        item = Base._to_item(self)
-        cfm_things = item.get('CreativeMaps')
-        if cfm_things:
-            item['CreativeMaps'] = [thing._to_item() for thing in cfm_things]
-        return item
-
     def __repr__(self):
         return '<Flight %s <Campaign %s>>' % (self.Id, self.CampaignId)
 
@@ -293,6 +809,7 @@ class Priority(Base):
 
 class Creative(Base):
     _name = 'creative'
+    _mirrored = True
     _fields = FieldSet(
         Field('Title'),
         Field('Body'),
@@ -309,14 +826,16 @@ class Creative(Base):
     )
 
     @classmethod
-    def list(cls, AdvertiserId):
+    def iterate(cls, AdvertiserId, page_size=None):
         url = '/'.join([cls._base_url, 'advertiser', str(AdvertiserId),
                         'creatives'])
-        response = requests.get(url, headers=cls._headers())
-        content = handle_response(response)
-        items = content.get('items')
-        if items:
-            return [cls._from_item(item) for item in items]
+        return cls._iter_pages(url, page_size)
+
+    @classmethod
+    def list(cls, AdvertiserId):
+        things = list(cls.iterate(AdvertiserId))
+        if things:
+            return things
 
     def __repr__(self):
         return '<Creative %s>' % (self.Id)
@@ -328,6 +847,7 @@ class CreativeFlightMap(Map):
     child = Creative
 
     _name = 'creative'
+    _mirrored = True
     _fields = FieldSet(
         Field('SizeOverride'),
         Field('CampaignId'),
@@ -344,16 +864,21 @@ class CreativeFlightMap(Map):
         Field('DistributionType'),
     )
 
-    def __setattr__(self, attr, val, **kw):
-        if attr == 'Creative':
+    @property
+    def Creative(self):
+        return self._Creative
+
+    @Creative.setter
+    def Creative(self, val):
+        if isinstance(val, dict):
             # Creative could be a full object or just a stub
-            d = val
+            d = dict(val)
             Id = d.pop('Id')
             if d:
                 val = Creative(Id, **d)
             else:
                 val = Stub(Id)
-        Map.__setattr__(self, attr, val, **kw)
+        self._Creative = val
 
     @classmethod
     def _from_item(cls, item):
@@ -411,6 +936,7 @@ class Publisher(Base):
 
 class Campaign(Base):
     _name = 'campaign'
+    _mirrored = True
     _fields = FieldSet(
         Field('Name'),
         Field('AdvertiserId'),
@@ -422,22 +948,14 @@ class Campaign(Base):
         Field('Price'),
     )
 
+    Flights = Nested('Flights', 'Flight')
+
     @classmethod
     def _from_item(cls, item):
-        if not 'Flights' in item or not item['Flights']:
-            item['Flights'] = []   # not always included in response
+        # not always included in response
+        item['Flights'] = Nested.raw(item.get('Flights'))
         thing = super(cls, cls)._from_item(item)
-        if hasattr(thing, 'Flights'):
-            thing.Flights = [Flight._from_item(flight)
-                             for flight in thing.Flights]
         return thing
 
-    def _to_item(self):
-        item = Base._to_item(self)
-        flights = item.get('Flights')
-        if flights:
-            item['Flights'] = [flight._to_item() for flight in flights]
-        return item
-
     def __repr__(self):
         return '<Campaign %s>' % (self.Id)
@@ -1,17 +1,26 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 import datetime
+import hashlib
 import json
 import string
+import threading
+import time
 from urllib import quote
 
 import adzerk_api
+from circuitbreaker import CircuitBreaker
 from pylons import c, g
+from promocache import get_no_promo_cache, normalize_keywords
+import instrument
+import sharding
+from singleflight import get_singleflight
+import workers
 import requests
 
 from r2.controllers import api, add_controller
 from r2.lib import (
     amqp,
-    authorize,
     organic,
     promote,
 )
@@ -27,6 +36,7 @@ from r2.lib.validator import (
 
 from r2.models import (
     Account,
+    Bid,
     CampaignBuilder,
     FakeSubreddit,
     Frontpage,
@@ -36,6 +46,7 @@ from r2.models import (
     PromotionLog,
     Subreddit,
 )
+from r2.models.traffic import TargetedImpressionsByCodename
 
 
 hooks = HookRegistrar()
@@ -44,6 +55,8 @@ ADZERK_IMPRESSION_BUMP = 500    # add extra impressions to the number we
                                 # request from adzerk in case their count
                                 # is lower than our internal traffic tracking
 
+_commit_lock = threading.RLock()
+
 DELCHARS = ''.join(c for c in map(chr, range(256)) if not (c.isalnum() or c.isspace()))
 
 def sanitize_text(text):
@@ -71,9 +84,22 @@ def render_link(link, campaign):
     })
 
 
+def attr_differs(adzerk_object, attr, val):
+    current = getattr(adzerk_object, attr, None)
+    if isinstance(val, dict) and 'Id' in val:
+        # nested objects (a CreativeFlightMap's Creative) are compared by Id
+        return getattr(current, 'Id', None) != val['Id']
+    return current != val
+
+
+def attrs_match(adzerk_object, d):
+    return not any(attr_differs(adzerk_object, attr, val)
+                   for attr, val in d.iteritems())
+
+
 def update_changed(adzerk_object, **d):
     changed = [(attr, val) for attr, val in d.iteritems()
-                          if getattr(adzerk_object, attr) != val]
+                          if attr_differs(adzerk_object, attr, val)]
     if changed:
         for (attr, val) in changed:
             setattr(adzerk_object, attr, val)
@@ -81,51 +107,112 @@ def update_changed(adzerk_object, **d):
     return changed
 
 
-def update_campaign(link):
-    """Add/update a reddit link as an Adzerk Campaign"""
-    if hasattr(link, 'adzerk_campaign_id'):
-        az_campaign = adzerk_api.Campaign.get(link.adzerk_campaign_id)
+def fingerprint(d):
+    """Stable hash of the attributes pushed to an Adzerk object."""
+    return hashlib.md5(json.dumps(d, sort_keys=True)).hexdigest()
+
+
+def is_unchanged(thing, fingerprint_attr, fp, force=False):
+    """Whether fp matches the fingerprint stored by the last sync.
+
+    A match means the Adzerk object already has the desired state so the
+    GET and PUT can be skipped. force=True always re-checks the remote
+    object, to catch drift from changes made outside this plugin.
+
+    """
+
+    return not force and getattr(thing, fingerprint_attr, None) == fp
+
+
+def commit_sync_state(thing, **attrs):
+    """Set and commit the adzerk ids/fingerprints stored on thing.
+
+    Sync stages for the same campaign may run in different threads, so
+    commits are serialized.
+
+    """
+
+    with _commit_lock:
+        changed = False
+        for attr, val in attrs.iteritems():
+            if getattr(thing, attr, None) != val:
+                setattr(thing, attr, val)
+                changed = True
+        if changed:
+            thing._commit()
+
+
+def optimistic_locking():
+    return g.config.get('az_optimistic_locking', False)
+
+
+@contextmanager
+def adzerk_lock(link):
+    """Hold the per-link adzerk lock, timing the wait and the hold."""
+    wait_timer = g.stats.get_timer('adzerk_lock.wait')
+    wait_timer.start()
+    start = time.time()
+    with g.make_lock('adzerk_update', 'adzerk-' + link._fullname):
+        wait_timer.stop()
+        instrument.add_time('lock.wait', time.time() - start)
+        hold_timer = g.stats.get_timer('adzerk_lock.hold')
+        hold_timer.start()
+        try:
+            yield
+        finally:
+            hold_timer.stop()
+
+
+@contextmanager
+def create_lock(link):
+    """Guard creating a missing Adzerk object and committing its id.
+
+    In optimistic mode this is the only time the per-link lock is held
+    during a sync. Otherwise the caller already holds it for the whole
+    sync and this does nothing.
+
+    """
+
+    if optimistic_locking():
+        with adzerk_lock(link):
+            yield
     else:
-        az_campaign = None
+        yield
 
-    d = {
+
+def refresh_id(thing, id_attr):
+    """Return thing's adzerk id, re-read from the db in optimistic mode.
+
+    Another consumer may have created the object since thing was loaded.
+
+    """
+
+    if optimistic_locking():
+        fresh = thing._byID(thing._id, data=True)
+        Id = getattr(fresh, id_attr, None)
+        if Id is not None:
+            setattr(thing, id_attr, Id)
+    return getattr(thing, id_attr, None)
+
+
+def campaign_attrs(link):
+    """Desired state of the Adzerk Campaign for a reddit link"""
+    return {
         'AdvertiserId': g.az_selfserve_advertiser_id,
         'IsDeleted': False,
         'IsActive': not link._deleted,
         'Price': 0,
     }
 
-    log_text = None
-    if az_campaign:
-        changed = update_changed(az_campaign, **d)
-    else:
-        d.update({
-            'Name': link._fullname,
-            'Flights': [],
-            'StartDate': date_to_adzerk(datetime.datetime.now(g.tz)),
-        })
-        az_campaign = adzerk_api.Campaign.create(**d)
-        link.adzerk_campaign_id = az_campaign.Id
-        link._commit()
-        log_text = 'created %s' % az_campaign
-
-    if log_text:
-        PromotionLog.add(link, log_text)
-        g.log.info(log_text)
-
-    return az_campaign
 
+def creative_title(link, campaign):
+    return '-'.join((link._fullname, campaign._fullname))
 
-def update_creative(link, campaign):
-    """Add/update a reddit link/campaign as an Adzerk Creative"""
-    if hasattr(campaign, 'adzerk_creative_id'):
-        az_creative = adzerk_api.Creative.get(campaign.adzerk_creative_id)
-    else:
-        az_creative = None
 
-    title = '-'.join((link._fullname, campaign._fullname))
-    d = {
-        'Body': title,
+def creative_attrs(link, campaign):
+    """Desired state of the Adzerk Creative for a reddit link/campaign"""
+    return {
+        'Body': creative_title(link, campaign),
         'ScriptBody': render_link(link, campaign),
         'AdvertiserId': g.az_selfserve_advertiser_id,
         'AdTypeId': g.az_selfserve_ad_type,
@@ -137,36 +224,9 @@ def update_creative(link, campaign):
         'IsActive': not campaign._deleted,
     }
 
-    log_text = None
-    if az_creative:
-        changed = update_changed(az_creative, **d)
-    else:
-        d.update({'Title': title})
-        try:
-            az_creative = adzerk_api.Creative.create(**d)
-        except:
-            raise ValueError(d)
-
-        campaign.adzerk_creative_id = az_creative.Id
-        campaign._commit()
-        log_text = 'created %s' % az_creative
-
-    if log_text:
-        PromotionLog.add(link, log_text)
-        g.log.info(log_text)
-
-    return az_creative
-
-
-def update_flight(link, campaign):
-    """Add/update a reddit campaign as an Adzerk Flight"""
-    if hasattr(campaign, 'adzerk_flight_id'):
-        az_flight = adzerk_api.Flight.get(campaign.adzerk_flight_id)
-    else:
-        az_flight = None
-
-    az_campaign = adzerk_api.Campaign.get(link.adzerk_campaign_id)
 
+def flight_attrs(link, campaign):
+    """Desired state of the Adzerk Flight for a reddit campaign"""
     d = {
         'StartDate': date_to_adzerk(campaign.start_date),
         'EndDate': date_to_adzerk(campaign.end_date),
@@ -174,7 +234,7 @@ def update_flight(link, campaign):
         'IsUnlimited': False,
         'IsFullSpeed': False,
         'Keywords': srname_to_keyword(campaign.sr_name),
-        'CampaignId': az_campaign.Id,
+        'CampaignId': getattr(link, 'adzerk_campaign_id', None),
         'PriorityId': g.az_selfserve_priority_id, # TODO: property of PromoCampaign
         'IsDeleted': False,
         'IsActive': not campaign._deleted,
@@ -196,107 +256,698 @@ def update_flight(link, campaign):
             'GoalType': 2, # 2: Percentage
             'RateType': 1, # 1: Flat
         })
+    return d
 
-    log_text = None
-    if az_flight:
-        changed = update_changed(az_flight, **d)
-    else:
-        d.update({'Name': campaign._fullname})
-        az_flight = adzerk_api.Flight.create(**d)
-        campaign.adzerk_flight_id = az_flight.Id
-        campaign._commit()
-        log_text = 'created %s' % az_flight
-
-    if log_text:
-        PromotionLog.add(link, log_text)
-        g.log.info(log_text)
-
-    return az_flight
-
-
-def update_cfmap(link, campaign):
-    """Add/update a CreativeFlightMap.
-    
-    Map the the reddit link (adzerk Creative) and reddit campaign (adzerk
-    Flight).
-
-    """
-
-    az_campaign = adzerk_api.Campaign.get(link.adzerk_campaign_id)
-    az_creative = adzerk_api.Creative.get(campaign.adzerk_creative_id)
-    az_flight = adzerk_api.Flight.get(campaign.adzerk_flight_id)
-
-    if hasattr(campaign, 'adzerk_cfmap_id'):
-        az_cfmap = adzerk_api.CreativeFlightMap.get(az_flight.Id,
-                                                    campaign.adzerk_cfmap_id)
-    else:
-        az_cfmap = None
 
-    d = {
+def cfmap_attrs(link, campaign):
+    """Desired state of the Adzerk CreativeFlightMap for a reddit campaign"""
+    return {
         'SizeOverride': False,
-        'CampaignId': az_campaign.Id,
+        'CampaignId': getattr(link, 'adzerk_campaign_id', None),
         'PublisherAccountId': g.az_selfserve_advertiser_id,
         'Percentage': 100,  # Each flight only has one creative (what about autobalanced)
         'DistributionType': 2, # 2: Percentage, 1: Auto-Balanced, 0: ???
         'Iframe': False,
-        'Creative': {'Id': az_creative.Id},
-        'FlightId': az_flight.Id,
+        'Creative': {'Id': getattr(campaign, 'adzerk_creative_id', None)},
+        'FlightId': getattr(campaign, 'adzerk_flight_id', None),
         'Impressions': 100, # Percentage
         'IsDeleted': False,
         'IsActive': not campaign._deleted,
     }
 
 
+# planner: computes the target state of each Adzerk object for an action,
+# compares it with the remote state and plans at most one write per object
+
+CREATE = 'create'
+UPDATE = 'update'
+NONE = 'none'
+
+ACTION_KINDS = {
+    'update_adzerk': ('campaign', 'creative', 'flight', 'cfmap'),
+    'deactivate_link': ('campaign',),
+    'deactivate_campaign': ('flight',),
+}
+
+# changes an action makes on top of the desired state
+ACTION_OVERRIDES = {
+    'deactivate_link': {'campaign': {'IsActive': False}},
+    'deactivate_campaign': {'flight': {'IsActive': False}},
+}
+
+
+class Ref(object):
+    """Id of an Adzerk object the plan is yet to create."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.Id = None
+
+    def __repr__(self):
+        return '<new %s>' % self.kind
+
+
+def has_ref(val):
+    if isinstance(val, dict):
+        return any(has_ref(v) for v in val.itervalues())
+    return isinstance(val, Ref)
+
+
+def resolve(val):
+    if isinstance(val, dict):
+        return {k: resolve(v) for k, v in val.iteritems()}
+    if isinstance(val, Ref):
+        if val.Id is None:
+            raise ValueError('%r is not created yet' % val)
+        return val.Id
+    return val
+
+
+class ObjectSpec(object):
+    """How one kind of Adzerk object maps onto a reddit link/campaign."""
+
+    def __init__(self, kind, model, owner, id_attr, fingerprint_attr,
+                 attrs, create_attrs, refs):
+        self.kind = kind
+        self.model = model
+        self.owner = owner
+        self.id_attr = id_attr
+        self.fingerprint_attr = fingerprint_attr
+        self.attrs = attrs
+        self.create_attrs = create_attrs
+        # attrs holding the id of another object, by that object's kind
+        self.refs = refs
+
+    def get(self, plan, Id):
+        # a forced sync checks for drift, so it mustn't trust the mirror
+        return self.model.get(Id, max_staleness=0 if plan.force else None)
+
+    def create(self, plan, attrs):
+        return self.model.create(**attrs)
+
+
+class CreativeFlightMapSpec(ObjectSpec):
+    def get(self, plan, Id):
+        return self.model.get(resolve(plan.ref('flight')), Id,
+                              max_staleness=0 if plan.force else None)
+
+    def create(self, plan, attrs):
+        return self.model.create(attrs['FlightId'], **attrs)
+
+
+OBJECT_SPECS = {
+    'campaign': ObjectSpec(
+        'campaign', adzerk_api.Campaign,
+        owner=lambda link, campaign: link,
+        id_attr='adzerk_campaign_id',
+        fingerprint_attr='adzerk_campaign_fingerprint',
+        attrs=lambda link, campaign: campaign_attrs(link),
+        create_attrs=lambda link, campaign: {
+            'Name': link._fullname,
+            'Flights': [],
+            'StartDate': date_to_adzerk(datetime.datetime.now(g.tz)),
+        },
+        refs={},
+    ),
+    'creative': ObjectSpec(
+        'creative', adzerk_api.Creative,
+        owner=lambda link, campaign: campaign,
+        id_attr='adzerk_creative_id',
+        fingerprint_attr='adzerk_creative_fingerprint',
+        attrs=creative_attrs,
+        create_attrs=lambda link, campaign: {
+            'Title': creative_title(link, campaign),
+        },
+        refs={},
+    ),
+    'flight': ObjectSpec(
+        'flight', adzerk_api.Flight,
+        owner=lambda link, campaign: campaign,
+        id_attr='adzerk_flight_id',
+        fingerprint_attr='adzerk_flight_fingerprint',
+        attrs=flight_attrs,
+        create_attrs=lambda link, campaign: {'Name': campaign._fullname},
+        refs={'CampaignId': 'campaign'},
+    ),
+    'cfmap': CreativeFlightMapSpec(
+        'cfmap', adzerk_api.CreativeFlightMap,
+        owner=lambda link, campaign: campaign,
+        id_attr='adzerk_cfmap_id',
+        fingerprint_attr='adzerk_cfmap_fingerprint',
+        attrs=cfmap_attrs,
+        create_attrs=lambda link, campaign: {},
+        refs={'CampaignId': 'campaign', 'Creative': 'creative',
+              'FlightId': 'flight'},
+    ),
+}
+
+
+class Step(object):
+    """The single write (create, update or none) planned for an object.
+
+    desired is the complete target state, attrs what will be sent: all of
+    it for a create, only the differing attributes for an update.
+
+    """
+
+    def __init__(self, kind, op, thing, desired, attrs, remote=None):
+        self.kind = kind
+        self.op = op
+        self.thing = thing
+        self.desired = desired
+        self.attrs = attrs
+        self.remote = remote
+
+    def __repr__(self):
+        return '<Step %s %s %s>' % (self.op, self.kind, sorted(self.attrs))
+
+
+class Plan(object):
+    """Ordered steps bringing the Adzerk objects for an action in line.
+
+    Executing a plan makes at most one create or PUT per object, see
+    writes(). plan_adzerk builds a complete plan without writing anything
+    (a dry run); _sync_adzerk plans and executes each object in turn.
+
+    """
+
+    def __init__(self, link, campaign, action='update_adzerk', force=False):
+        self.link = link
+        self.campaign = campaign
+        self.action = action
+        self.force = force
+        self.steps = OrderedDict()
+        self.refs = {}
+        self.lock = threading.Lock()
+
+    def ref(self, kind):
+        """The id of kind's object, or a Ref if it's yet to be created."""
+        spec = OBJECT_SPECS[kind]
+        thing = spec.owner(self.link, self.campaign)
+        Id = getattr(thing, spec.id_attr, None)
+        if Id is not None:
+            return Id
+        with self.lock:
+            return self.refs.setdefault(kind, Ref(kind))
+
+    def add(self, step):
+        with self.lock:
+            self.steps[step.kind] = step
+        return step
+
+    def writes(self):
+        return [step for step in self.steps.itervalues() if step.op != NONE]
+
+    def __iter__(self):
+        return iter(self.steps.values())
+
+    def __repr__(self):
+        return '<Plan %s %s: %s>' % (self.action, self.link,
+                                     ', '.join(map(repr, self)))
+
+
+def desired_state(plan, kind):
+    spec = OBJECT_SPECS[kind]
+    d = spec.attrs(plan.link, plan.campaign)
+    d.update(ACTION_OVERRIDES.get(plan.action, {}).get(kind, {}))
+    for attr, ref_kind in spec.refs.iteritems():
+        if attr == 'Creative':
+            if d[attr]['Id'] is None:
+                d[attr] = {'Id': plan.ref(ref_kind)}
+        elif d[attr] is None:
+            d[attr] = plan.ref(ref_kind)
+    return d
+
+
+def plan_object(plan, kind):
+    """Compare kind's desired and remote state and add the step to plan.
+
+    The remote object is only fetched if the fingerprint stored by the
+    last sync doesn't match (or plan.force is set).
+
+    """
+
+    spec = OBJECT_SPECS[kind]
+    thing = spec.owner(plan.link, plan.campaign)
+    d = desired_state(plan, kind)
+    Id = getattr(thing, spec.id_attr, None)
+
+    if Id is None:
+        return plan.add(Step(kind, CREATE, thing, d, d))
+
+    if not has_ref(d):
+        fp = fingerprint(d)
+        if is_unchanged(thing, spec.fingerprint_attr, fp, plan.force):
+            return plan.add(Step(kind, NONE, thing, d, {},
+                                 remote=adzerk_api.Stub(Id)))
+
+    remote = spec.get(plan, Id)
+    changed = {attr: val for attr, val in d.iteritems()
+               if has_ref(val) or attr_differs(remote, attr, val)}
+    op = UPDATE if changed else NONE
+    return plan.add(Step(kind, op, thing, d, changed, remote=remote))
+
+
+def execute_step(plan, step):
+    """Make step's write and record the new sync state on its owner."""
+    spec = OBJECT_SPECS[step.kind]
+    link, campaign = plan.link, plan.campaign
+    desired = resolve(step.desired)
+    az_object = step.remote
     log_text = None
-    if az_cfmap:
-        changed = update_changed(az_cfmap, **d)
-    else:
-        az_cfmap = adzerk_api.CreativeFlightMap.create(az_flight.Id, **d)
-        campaign.adzerk_cfmap_id = az_cfmap.Id
-        campaign._commit()
-        log_text = 'created %s' % az_cfmap
+    changed = step.attrs
+
+    if step.op == CREATE:
+        with create_lock(link):
+            if not refresh_id(step.thing, spec.id_attr):
+                attrs = dict(desired, **spec.create_attrs(link, campaign))
+                az_object = spec.create(plan, attrs)
+                commit_sync_state(step.thing,
+                                  **{spec.id_attr: az_object.Id})
+                log_text = 'created %s' % az_object
+        if az_object is None:
+            # created by another consumer while we waited for the lock
+            az_object = spec.get(plan, getattr(step.thing, spec.id_attr))
+            changed = dict(update_changed(az_object, **desired))
+    elif step.op == UPDATE:
+        for attr, val in resolve(step.attrs).iteritems():
+            setattr(az_object, attr, val)
+        az_object._send()
+
+    if step.kind in plan.refs:
+        plan.refs[step.kind].Id = az_object.Id
+
+    if step.kind == 'flight' and (log_text or 'Keywords' in changed):
+        # keyword sets cached as having no promo may now match this flight
+        get_no_promo_cache().invalidate()
+
+    commit_sync_state(step.thing,
+                      **{spec.fingerprint_attr: fingerprint(desired)})
 
     if log_text:
         PromotionLog.add(link, log_text)
         g.log.info(log_text)
 
-    return az_cfmap
+    return az_object
 
 
-def update_adzerk(link, campaign):
+def sync_object(plan, kind):
+    return execute_step(plan, plan_object(plan, kind))
+
+
+def plan_adzerk(link, campaign, action='update_adzerk', force=False):
+    """Dry run: return the Plan for action without writing anything.
+
+    Objects that would be created are referred to by Ref in the steps
+    that depend on them.
+
+    """
+
+    plan = Plan(link, campaign, action, force)
+    for kind in ACTION_KINDS[action]:
+        plan_object(plan, kind)
+    return plan
+
+
+# adzerk_q is the priority lane for deactivations and edits, the daily
+# sweep's updates go to the bulk lane so they can't delay them
+PRIORITY_LANE = 'priority'
+BULK_LANE = 'bulk'
+LANE_QUEUES = {
+    PRIORITY_LANE: 'adzerk_q',
+    BULK_LANE: 'adzerk_bulk_q',
+}
+# lanes are weighted by the number of consumer instances started for each,
+# so each lane has its own instance count for sharding
+LANE_SHARD_INSTANCES = {
+    PRIORITY_LANE: 'az_consumer_shard_instances',
+    BULK_LANE: 'az_consumer_bulk_shard_instances',
+}
+
+
+def shard_instances(lane):
+    """Number of consumer instances sharing lane's shards, 0 if unsharded."""
+    return g.config.get(LANE_SHARD_INSTANCES[lane], 0)
+
+
+def sharded(lane):
+    return shard_instances(lane) > 0
+
+
+def queue_adzerk_message(data, lane=PRIORITY_LANE):
+    """Queue data in lane, on its link's shard if the lane is sharded."""
+    queue = LANE_QUEUES[lane]
+    if sharded(lane):
+        shard = sharding.shard_for(data['link'])
+        queue = sharding.shard_queue(queue, shard)
+    data['queued_at'] = time.time()
+    amqp.add_item(queue, json.dumps(data))
+
+
+def lane_queues(lane, instance=None):
+    """Queues consumed by consumer instance (numbered from 0) of lane.
+
+    Unsharded, or without an instance number, that's the lane's queue.
+    Otherwise it's the instance's share of the lane's shard queues, and
+    the first instance also drains the unsharded queue in case messages
+    were left there when sharding was turned on. The lane's instance
+    count must match the instances actually started (0 to N - 1, at most
+    sharding.NUM_SHARDS), an instance outside it raises ValueError.
+
+    """
+
+    queue = LANE_QUEUES[lane]
+    if not sharded(lane) or instance is None:
+        return [queue]
+
+    queues = [sharding.shard_queue(queue, shard)
+              for shard in sharding.shards_for_instance(
+                  instance, shard_instances(lane))]
+    if instance == 0:
+        queues.append(queue)
+    return queues
+
+
+def update_adzerk(link, campaign, force=False, lane=PRIORITY_LANE):
     g.log.debug('queuing update_adzerk %s %s' % (link, campaign))
-    msg = json.dumps({
+    queue_adzerk_message({
         'action': 'update_adzerk',
         'link': link._fullname,
         'campaign': campaign._fullname,
-    })
-    amqp.add_item('adzerk_q', msg)
+        'force': force,
+    }, lane=lane)
 
 
-def _update_adzerk(link, campaign):
-    with g.make_lock('adzerk_update', 'adzerk-' + link._fullname):
-        msg = '%s updating/creating adzerk objects for %s - %s'
-        g.log.info(msg % (datetime.datetime.now(g.tz), link, campaign))
-        az_campaign = update_campaign(link)
-        az_creative = update_creative(link, campaign)
-        az_flight = update_flight(link, campaign)
-        az_cfmap = update_cfmap(link, campaign)
-
-
-def make_adzerk_promotions(offset=0):
-    # campaign goes live if is_charged_transaction and is_accepted
-    for link, campaign, weight in promote.accepted_campaigns(offset=offset):
-        if (authorize.is_charged_transaction(campaign.trans_id, campaign._id)
-            and promote.is_accepted(link)):
-            if is_overdelivered(campaign):
+MAX_SYNC_ATTEMPTS = 3
+
+
+def desired_fingerprints(link, campaign, action='update_adzerk'):
+    """Fingerprints of the reddit side state action syncs for link/campaign.
+
+    Attributes holding the ids of other Adzerk objects are left out, the
+    sync itself assigns those when it creates the objects.
+
+    """
+
+    fingerprints = []
+    for kind in ACTION_KINDS[action]:
+        spec = OBJECT_SPECS[kind]
+        d = spec.attrs(link, campaign)
+        for attr in spec.refs:
+            del d[attr]
+        fingerprints.append(fingerprint(d))
+    return fingerprints
+
+
+def run_sync(action, sync, link, campaign, force=False):
+    """Call sync(link, campaign, force), guarded against concurrent syncs.
+
+    Normally the per-link lock is held for the whole sync. In optimistic
+    mode no lock is held across the remote calls (create_lock guards
+    creating missing objects), instead link and campaign are re-read
+    afterwards. If the state action syncs changed meanwhile a concurrent
+    consumer may have pushed newer state that our PUTs overwrote, so sync
+    again from the fresh copy.
+
+    """
+
+    if not optimistic_locking():
+        with adzerk_lock(link), adzerk_api.unit_of_work():
+            sync(link, campaign, force)
+        return
+
+    for attempt in xrange(MAX_SYNC_ATTEMPTS):
+        synced = desired_fingerprints(link, campaign, action)
+        with adzerk_api.unit_of_work():
+            sync(link, campaign, force)
+
+        link = Link._byID(link._id, data=True)
+        if campaign is not None:
+            campaign = PromoCampaign._byID(campaign._id, data=True)
+        if desired_fingerprints(link, campaign, action) == synced:
+            return
+
+        g.stats.simple_event('adzerk.sync.conflict')
+        force = True
+
+    g.log.warning('adzerk %s of %s - %s kept conflicting' %
+                  (action, link, campaign))
+
+
+def _update_adzerk(link, campaign, force=False):
+    run_sync('update_adzerk', _sync_adzerk, link, campaign, force)
+
+
+def _sync_adzerk(link, campaign, force=False):
+    msg = '%s updating/creating adzerk objects for %s - %s'
+    g.log.info(msg % (datetime.datetime.now(g.tz), link, campaign))
+    plan = Plan(link, campaign, 'update_adzerk', force)
+    stages = [
+        ('campaign', lambda: sync_object(plan, 'campaign'), []),
+        ('creative', lambda: sync_object(plan, 'creative'), ['campaign']),
+        ('flight', lambda: sync_object(plan, 'flight'), ['campaign']),
+        ('cfmap', lambda: sync_object(plan, 'cfmap'), ['creative', 'flight']),
+    ]
+    pool = workers.get_pool('adzerk_stage',
+                            g.config.get('az_consumer_stage_workers', 1))
+    workers.run_stages(stages, pool=pool)
+
+
+BULK_QUERY_SIZE = 500
+
+
+def chunks(items, size=BULK_QUERY_SIZE):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_charged_transactions(campaigns):
+    """Bulk authorize.is_charged_transaction.
+
+    Returns the set of (trans_id, campaign id) pairs whose bid has been
+    charged, looked up with one query per BULK_QUERY_SIZE transactions.
+
+    """
+
+    trans_ids = {campaign.trans_id for campaign in campaigns
+                 if campaign.trans_id}
+    charged = set()
+    for trans_id_chunk in chunks(trans_ids):
+        bids = Bid.query().filter(Bid.transaction.in_(trans_id_chunk))
+        charged.update((bid.transaction, bid.campaign) for bid in bids
+                       if bid.is_charged())
+    return charged
+
+
+def get_billable_impressions_by_campaign(campaigns):
+    """Bulk promote.get_billable_impressions, by campaign _id.
+
+    Impressions for all campaigns are fetched with one traffic query per
+    BULK_QUERY_SIZE campaigns over the union of their billable date ranges
+    and then summed over each campaign's own range.
+
+    """
+
+    billable = {}
+    for campaign_chunk in chunks(campaigns):
+        dates = {campaign._fullname: promote.get_traffic_dates(campaign)
+                 for campaign in campaign_chunk}
+        start = min(start for start, end in dates.itervalues())
+        end = max(end for start, end in dates.itervalues())
+        history = TargetedImpressionsByCodename.campaign_history(
+            dates.keys(), start.replace(tzinfo=None), end.replace(tzinfo=None))
+
+        impressions = dict.fromkeys(dates, 0)
+        for date, codename, values in history:
+            campaign_start, campaign_end = dates[codename]
+            date = date.replace(tzinfo=None)
+            if (campaign_start.replace(tzinfo=None) <= date <
+                    campaign_end.replace(tzinfo=None)):
+                impressions[codename] += values[-1]
+
+        for campaign in campaign_chunk:
+            billable[campaign._id] = impressions[campaign._fullname]
+    return billable
+
+
+def get_live_campaigns(offset=0):
+    """Yield (link, campaign, is_overdelivered) for campaigns that go live.
+
+    The links are already multi-fetched by promote.accepted_campaigns.
+
+    """
+
+    return check_live_campaigns(
+        (link, campaign) for link, campaign, weight
+        in promote.accepted_campaigns(offset=offset))
+
+
+def check_live_campaigns(candidates):
+    """Yield (link, campaign, is_overdelivered) for candidates that go live.
+
+    A campaign goes live if its link is accepted and its transaction is
+    charged. Charge status and billable impressions of all candidates are
+    looked up in bulk first instead of once per campaign.
+
+    """
+
+    candidates = [(link, campaign) for link, campaign in candidates
+                  if promote.is_accepted(link)]
+
+    charged = get_charged_transactions(campaign for link, campaign
+                                       in candidates)
+    candidates = [(link, campaign) for link, campaign in candidates
+                  if (campaign.trans_id, campaign._id) in charged]
+
+    billable = get_billable_impressions_by_campaign(
+        [campaign for link, campaign in candidates
+         if hasattr(campaign, 'cpm')])
+
+    for link, campaign in candidates:
+        overdelivered = (hasattr(campaign, 'cpm') and
+                         billable[campaign._id] >= campaign.impressions)
+        yield link, campaign, overdelivered
+
+
+def make_adzerk_promotions(offset=0, force=False):
+    for link, campaign, overdelivered in get_live_campaigns(offset):
+        if overdelivered:
+            deactivate_campaign(link, campaign)
+        else:
+            update_adzerk(link, campaign, force=force, lane=BULK_LANE)
+
+
+class RemoteState(object):
+    """Bulk snapshot of the self-serve advertiser's objects in Adzerk.
+
+    Campaigns, Flights and Creatives are listed a page at a time rather
+    than fetched one by one, CreativeFlightMaps come from the listed
+    Flights when the listing includes their CreativeMaps.
+
+    """
+
+    def __init__(self, campaigns, flights, creatives):
+        self.campaigns = {thing.Id: thing for thing in campaigns}
+        self.flights = {thing.Id: thing for thing in flights}
+        self.creatives = {thing.Id: thing for thing in creatives}
+        self.cfmaps = {cfmap.Id: cfmap
+                       for flight in self.flights.itervalues()
+                       for cfmap in (getattr(flight, 'CreativeMaps', None)
+                                     or [])}
+
+    @classmethod
+    def fetch(cls):
+        advertiser_id = g.az_selfserve_advertiser_id
+        campaigns = [thing for thing in adzerk_api.Campaign.iterate()
+                     if getattr(thing, 'AdvertiserId', None) == advertiser_id]
+        campaign_ids = {thing.Id for thing in campaigns}
+        flights = [thing for thing in adzerk_api.Flight.iterate()
+                   if getattr(thing, 'CampaignId', None) in campaign_ids]
+        creatives = adzerk_api.Creative.iterate(advertiser_id)
+        return cls(campaigns, flights, creatives)
+
+    def things(self):
+        for things in (self.campaigns, self.flights, self.creatives,
+                       self.cfmaps):
+            for thing in things.itervalues():
+                yield thing
+
+
+def is_synced(link, campaign, remote):
+    """Whether every Adzerk object for link/campaign has the desired state.
+
+    The flight list endpoint doesn't return CreativeMaps, so a map that
+    isn't in remote is taken to be in sync if the fingerprint stored by
+    its last sync matches, rather than fetching it.
+
+    """
+
+    remote_things = {
+        'campaign': remote.campaigns,
+        'creative': remote.creatives,
+        'flight': remote.flights,
+        'cfmap': remote.cfmaps,
+    }
+    plan = Plan(link, campaign)
+    for kind in ACTION_KINDS['update_adzerk']:
+        spec = OBJECT_SPECS[kind]
+        thing = spec.owner(link, campaign)
+        Id = getattr(thing, spec.id_attr, None)
+        if Id is None:
+            return False
+
+        d = desired_state(plan, kind)
+        remote_thing = remote_things[kind].get(Id)
+        if remote_thing is not None:
+            if not attrs_match(remote_thing, d):
+                return False
+        elif (kind != 'cfmap' or
+                not is_unchanged(thing, spec.fingerprint_attr,
+                                 fingerprint(d))):
+            return False
+    return True
+
+
+def reconcile_adzerk_promotions(offset=0):
+    """Bring Adzerk in line with every live campaign in one bulk pass.
+
+    Alternative to make_adzerk_promotions for the daily sweep. The remote
+    state is listed in bulk once and compared with the desired state in
+    memory; only campaigns that differ are synced, inline and with the
+    listed objects standing in for the per-object GETs. A campaign that
+    fails to sync is queued as a regular update_adzerk message instead.
+
+    """
+
+    remote = RemoteState.fetch()
+    synced = updated = 0
+
+    with adzerk_api.unit_of_work() as identity_map:
+        for thing in remote.things():
+            identity_map.add(thing)
+
+        for link, campaign, overdelivered in get_live_campaigns(offset):
+            if overdelivered:
                 deactivate_campaign(link, campaign)
+            elif is_synced(link, campaign, remote):
+                synced += 1
             else:
-                update_adzerk(link, campaign)
+                try:
+                    _update_adzerk(link, campaign, force=True)
+                except Exception:
+                    g.log.exception('reconcile failed for %s - %s' %
+                                    (link, campaign))
+                    update_adzerk(link, campaign, force=True,
+                                  lane=BULK_LANE)
+                updated += 1
+
+    g.stats.simple_event('adzerk.reconcile.synced', delta=synced)
+    g.stats.simple_event('adzerk.reconcile.updated', delta=updated)
+    g.log.info('adzerk reconcile: %s in sync, %s updated' % (synced, updated))
+
+
+def is_drift_check_day(date=None):
+    """Whether the daily sweep should ignore fingerprints and re-check.
+
+    Every az_drift_check_interval days the sweep compares each object with
+    its remote copy so edits made directly in Adzerk get reverted.
+
+    """
+
+    interval = g.config.get('az_drift_check_interval', 7)
+    if not interval:
+        return False
+    date = date or datetime.datetime.now(g.tz).date()
+    return date.toordinal() % interval == 0
 
 
 @hooks.on('promote.make_daily_promotions')
 def adzerk_live_promotions(offset=0):
-    make_adzerk_promotions(offset)
+    if g.config.get('az_reconcile_daily', False):
+        reconcile_adzerk_promotions(offset)
+    else:
+        make_adzerk_promotions(offset, force=is_drift_check_day())
 
 
 @hooks.on('promote.new_charge')
@@ -314,20 +965,21 @@ def deactivate_link(link):
         return
 
     g.log.debug('queuing deactivate_link %s' % link)
-    msg = json.dumps({
+    queue_adzerk_message({
         'action': 'deactivate_link',
         'link': link._fullname,
     })
-    amqp.add_item('adzerk_q', msg)
 
 
 def _deactivate_link(link):
-    with g.make_lock('adzerk_update', 'adzerk-' + link._fullname):
-        g.log.debug('running deactivate_link %s' % link)
-        az_campaign = update_campaign(link)
-        az_campaign.IsActive = False
-        az_campaign._send()
-        PromotionLog.add(link, 'deactivated %s' % az_campaign)
+    run_sync('deactivate_link', _sync_deactivate_link, link, None)
+
+
+def _sync_deactivate_link(link, campaign, force):
+    g.log.debug('running deactivate_link %s' % link)
+    plan = Plan(link, None, 'deactivate_link', force=True)
+    az_campaign = sync_object(plan, 'campaign')
+    PromotionLog.add(link, 'deactivated %s' % az_campaign)
 
 
 @hooks.on('campaign.edit')
@@ -347,54 +999,425 @@ def deactivate_campaign(link, campaign):
         return
 
     g.log.debug('queuing deactivate_campaign %s' % link)
-    msg = json.dumps({
+    queue_adzerk_message({
         'action': 'deactivate_campaign',
         'link': link._fullname,
         'campaign': campaign._fullname,
     })
-    amqp.add_item('adzerk_q', msg)
 
 
 def _deactivate_campaign(link, campaign):
-    with g.make_lock('adzerk_update', 'adzerk-' + link._fullname):
-        g.log.debug('running deactivate_campaign %s' % link)
-        az_flight = update_flight(link, campaign)
-        az_flight.IsActive = False
-        az_flight._send()
-        PromotionLog.add(link, 'deactivated %s' % az_flight)
+    run_sync('deactivate_campaign', _sync_deactivate_campaign, link, campaign)
 
 
-def is_overdelivered(campaign):
-    if not hasattr(campaign, 'cpm'):
-        return False
+def _sync_deactivate_campaign(link, campaign, force):
+    g.log.debug('running deactivate_campaign %s' % link)
+    plan = Plan(link, campaign, 'deactivate_campaign', force=True)
+    az_flight = sync_object(plan, 'flight')
+    PromotionLog.add(link, 'deactivated %s' % az_flight)
+
+
+DELIVERED_CACHE_PREFIX = 'adzerk_delivered-'
+DELIVERED_CACHE_TIME = 7 * 24 * 60 * 60
+
+
+def flight_is_deactivated(link, campaign):
+    """Whether the last sync of campaign's flight was a deactivation."""
+    d = desired_state(Plan(link, campaign, 'deactivate_campaign'), 'flight')
+    return (not has_ref(d) and
+            getattr(campaign, 'adzerk_flight_fingerprint', None) ==
+            fingerprint(d))
+
 
-    billable_impressions = promote.get_billable_impressions(campaign)
-    return billable_impressions >= campaign.impressions
-
-
-def process_adzerk():
-    @g.stats.amqp_processor('adzerk_q')
-    def _handle_adzerk(msg):
-        data = json.loads(msg.body)
-        g.log.debug('data: %s' % data)
-        action = data.get('action')
-        if action == 'deactivate_link':
-            link = Link._by_fullname(data['link'], data=True)
-            _deactivate_link(link)
-        elif action == 'deactivate_campaign':
-            link = Link._by_fullname(data['link'], data=True)
-            campaign = PromoCampaign._by_fullname(data['campaign'], data=True)
-            _deactivate_campaign(link, campaign)
-        elif action == 'update_adzerk':
-            link = Link._by_fullname(data['link'], data=True)
-            campaign = PromoCampaign._by_fullname(data['campaign'], data=True)
-            _update_adzerk(link, campaign)
-    amqp.consume_items('adzerk_q', _handle_adzerk, verbose=False)
+def monitor_overdelivery():
+    """Deactivate CPM flights that reached their goal.
+
+    Billable impressions of every live CPM campaign that has an Adzerk
+    flight are fetched in bulk and compared against a per-campaign high
+    water mark kept in memcache. deactivate_campaign is queued for
+    campaigns whose delivery crossed campaign.impressions since the
+    previous tick, and again for overdelivered campaigns whose flight
+    fingerprint shows a later update turned it back on.
+
+    """
+
+    live = [(link, campaign) for link, campaign, weight
+            in promote.accepted_campaigns()
+            if hasattr(campaign, 'cpm') and
+               hasattr(campaign, 'adzerk_flight_id')]
+    if not live:
+        return
+
+    billable = get_billable_impressions_by_campaign(
+        [campaign for link, campaign in live])
+    previous = g.cache.get_multi([campaign._fullname
+                                  for link, campaign in live],
+                                 prefix=DELIVERED_CACHE_PREFIX)
+
+    high_water_marks = {}
+    crossed = reactivated = 0
+    for link, campaign in live:
+        before = previous.get(campaign._fullname, 0)
+        delivered = billable[campaign._id]
+        if delivered > before:
+            high_water_marks[campaign._fullname] = delivered
+        if delivered < campaign.impressions:
+            continue
+
+        if before < campaign.impressions:
+            crossed += 1
+        elif flight_is_deactivated(link, campaign):
+            continue
+        else:
+            reactivated += 1
+        deactivate_campaign(link, campaign)
+
+    if high_water_marks:
+        g.cache.set_multi(high_water_marks, prefix=DELIVERED_CACHE_PREFIX,
+                          time=DELIVERED_CACHE_TIME)
+
+    g.stats.simple_event('adzerk.overdelivery.checked', delta=len(live))
+    if crossed:
+        g.stats.simple_event('adzerk.overdelivery.crossed', delta=crossed)
+    if reactivated:
+        g.stats.simple_event('adzerk.overdelivery.reactivated',
+                             delta=reactivated)
+
+
+def run_overdelivery_monitor(interval=None):
+    """Run monitor_overdelivery every interval seconds, forever."""
+    if interval is None:
+        interval = g.config.get('az_overdelivery_interval', 300)
+
+    while True:
+        start = time.time()
+        g.reset_caches()
+        try:
+            monitor_overdelivery()
+        except Exception:
+            g.log.exception('adzerk overdelivery monitor failed')
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+def report_breakdown(action, message_breakdown):
+    """Send where a message's time went as adzerk_message.<action> timings.
+
+    api and lock_wait sum the time of every API call and lock wait, other
+    is the rest of the wall time (db, rendering, etc.).
+
+    """
+
+    timer = g.stats.get_timer('adzerk_message.%s' % action)
+    elapsed = message_breakdown.elapsed()
+    api = message_breakdown.total('api.')
+    lock_wait = message_breakdown.total('lock.')
+    timer.send('total', elapsed)
+    timer.send('api', api)
+    timer.send('lock_wait', lock_wait)
+    timer.send('other', max(0, elapsed - api - lock_wait))
+    for category, category_time in message_breakdown.times.items():
+        timer.send(category, category_time)
+    g.log.debug('%s breakdown: %s' % (action, message_breakdown))
+
+
+def handle_adzerk_message(data):
+    g.log.debug('data: %s' % data)
+    action = data.get('action')
+    with instrument.breakdown() as message_breakdown:
+        try:
+            _handle_adzerk_message(action, data)
+        finally:
+            report_breakdown(action, message_breakdown)
+
+
+def _handle_adzerk_message(action, data):
+    if action == 'deactivate_link':
+        link = Link._by_fullname(data['link'], data=True)
+        _deactivate_link(link)
+    elif action == 'deactivate_campaign':
+        link = Link._by_fullname(data['link'], data=True)
+        campaign = PromoCampaign._by_fullname(data['campaign'], data=True)
+        _deactivate_campaign(link, campaign)
+    elif action == 'update_adzerk':
+        link = Link._by_fullname(data['link'], data=True)
+        campaign = PromoCampaign._by_fullname(data['campaign'], data=True)
+        _update_adzerk(link, campaign, force=data.get('force', False))
+
+
+def drop_stale_updates(messages):
+    """Drop update_adzerk messages for campaigns that are no longer live.
+
+    The priority lane can deactivate a campaign while updates the daily
+    sweep queued before are still waiting in the bulk lane. Those would
+    turn it back on, so bulk lane updates are checked again the way the
+    sweep checks them (accepted, charged and not overdelivered) with the
+    same bulk lookups, and skipped if the sweep wouldn't send them now.
+
+    """
+
+    updates = [data for data in messages
+               if data.get('action') == 'update_adzerk']
+    if not updates:
+        return messages
+
+    links = Link._by_fullname(list({data['link'] for data in updates}),
+                              data=True, return_dict=True)
+    campaigns = PromoCampaign._by_fullname(
+        list({data['campaign'] for data in updates}),
+        data=True, return_dict=True)
+    live = {campaign._fullname for link, campaign, overdelivered
+            in check_live_campaigns((links[data['link']],
+                                     campaigns[data['campaign']])
+                                    for data in updates)
+            if not overdelivered}
+
+    kept = [data for data in messages
+            if data.get('action') != 'update_adzerk' or
+               data['campaign'] in live]
+    dropped = len(messages) - len(kept)
+    if dropped:
+        g.stats.simple_event('adzerk_lane.%s.stale' % BULK_LANE,
+                             delta=dropped)
+    return kept
+
+
+def coalesce_messages(messages):
+    """Collapse redundant adzerk_q messages, keeping their relative order.
+
+    Only the last message for each (link, campaign) is kept because every
+    action re-reads the link and campaign and so supersedes earlier ones,
+    e.g. a deactivate_campaign overrides a pending update_adzerk. A
+    deactivate_link also supersedes the update_adzerk messages queued
+    before it for that link, but not a deactivate_campaign: it only
+    deactivates the Adzerk campaign, so the flight would otherwise stay
+    active and serve again once the link is reactivated. A dropped forced
+    update passes its force flag on to the update that replaces it.
+
+    """
+
+    pending = OrderedDict()
+    for data in messages:
+        link = data.get('link')
+        if data.get('action') == 'deactivate_link':
+            for key in [key for key, queued in pending.iteritems()
+                        if key[0] == link and
+                        queued.get('action') == 'update_adzerk']:
+                del pending[key]
+            key = (link, None)
+        else:
+            key = (link, data.get('campaign'))
+
+        previous = pending.pop(key, None)
+        if (previous and previous.get('force') and
+                previous.get('action') == data.get('action')):
+            data['force'] = True
+        pending[key] = data
+    return pending.values()
+
+
+LANE_DEPTH_INTERVAL = 10
+
+
+class LaneStats(object):
+    """Report the age of consumed messages and the depth of a lane's queues.
+
+    Ages are sent as timings under adzerk_lane.<lane>.age so their mean
+    and upper bound can be graphed. r2's stats client has no gauges, so
+    the depth is sampled at most every LANE_DEPTH_INTERVAL seconds and
+    added to the adzerk_lane.<lane>.depth counter. With statsd's default
+    10 second flush each flushed value is one sample of the depth.
+
+    """
+
+    def __init__(self, lane, queues):
+        self.lane = lane
+        self.queues = queues
+        self.depth_checked = 0
+        self.received = 0
+
+    def record(self, messages, chan):
+        self.received += len(messages)
+        timer = g.stats.get_timer('adzerk_lane.%s' % self.lane)
+        now = time.time()
+        for data in messages:
+            if 'queued_at' in data:
+                timer.send('age', max(0, now - data['queued_at']))
+
+        if (chan is not None and
+                now - self.depth_checked >= LANE_DEPTH_INTERVAL):
+            self.depth_checked = now
+            try:
+                depth = sum(chan.queue_declare(queue=queue, passive=True)[1]
+                            for queue in self.queues)
+            except Exception:
+                g.log.exception('failed to read depth of %s' % self.queues)
+            else:
+                g.stats.simple_event('adzerk_lane.%s.depth' % self.lane,
+                                     delta=depth)
+
+
+def process_adzerk(batch_size=None, batch_wait_ms=None, lane=PRIORITY_LANE,
+                   instance=None):
+    """Consume one lane of adzerk messages (adzerk_q or adzerk_bulk_q).
+
+    Run dedicated consumers per lane and weight the lanes through the
+    number of consumer instances started for each. If the lane is sharded
+    (az_consumer_shard_instances for the priority lane,
+    az_consumer_bulk_shard_instances for the bulk lane) instance picks the
+    shards this consumer reads, see lane_queues.
+
+    With a batch size above 1 up to batch_size messages are pulled at once
+    (waiting batch_wait_ms between polls of an empty queue), coalesced and
+    processed before the whole batch is acked. If any message fails the
+    batch is requeued. Messages for different links in a batch run
+    concurrently on az_consumer_link_workers threads.
+
+    In batch mode bulk lane updates for campaigns that stopped being live
+    since they were queued are dropped, see drop_stale_updates. That check
+    costs a charge and a traffic query per batch, so it's skipped when
+    messages are handled one at a time: run the bulk lane with a batch
+    size above 1.
+
+    """
+
+    if batch_size is None:
+        batch_size = g.config.get('az_consumer_batch_size', 1)
+    if batch_wait_ms is None:
+        batch_wait_ms = g.config.get('az_consumer_batch_wait_ms', 1000)
+
+    queue = LANE_QUEUES[lane]
+    queues = lane_queues(lane, instance)
+    lane_stats = LaneStats(lane, queues)
+
+    if batch_size <= 1:
+        @g.stats.amqp_processor(queue)
+        def _handle_adzerk(msg):
+            data = json.loads(msg.body)
+            lane_stats.record([data], getattr(msg, 'channel', None))
+            handle_adzerk_message(data)
+        amqp.consume_items(queues, _handle_adzerk, verbose=False)
+        return
+
+    def _handle_adzerk_batch(msgs, chan):
+        messages = [json.loads(msg.body) for msg in msgs]
+        lane_stats.record(messages, chan)
+        to_process = coalesce_messages(messages)
+        coalesced = len(messages) - len(to_process)
+        if lane == BULK_LANE:
+            to_process = drop_stale_updates(to_process)
+        g.stats.simple_event('%s.batch.received' % queue, delta=len(messages))
+        if coalesced:
+            g.stats.simple_event('%s.batch.coalesced' % queue,
+                                 delta=coalesced)
+
+        # messages for different links are independent and can run
+        # concurrently, those for the same link keep their order
+        by_link = OrderedDict()
+        for data in to_process:
+            by_link.setdefault(data.get('link'), []).append(data)
+
+        def _handle_link_messages(link_messages):
+            for data in link_messages:
+                handle_adzerk_message(data)
+
+        pool = workers.get_pool('adzerk_link',
+                                g.config.get('az_consumer_link_workers', 1))
+        if pool is None:
+            for link_messages in by_link.itervalues():
+                _handle_link_messages(link_messages)
+        else:
+            # wait for every link before raising so a failure can't requeue
+            # the batch (or exit) while other links are mid-write
+            pending = [pool.apply_async(_handle_link_messages, link_messages)
+                       for link_messages in by_link.itervalues()]
+            for async_result in pending:
+                async_result.wait()
+            for async_result in pending:
+                async_result.get()
+
+    if len(queues) == 1:
+        amqp.handle_items(queues[0], _handle_adzerk_batch, limit=batch_size,
+                          sleep_time=batch_wait_ms / 1000., verbose=False)
+        return
+
+    # handle_items reads a single queue, so drain this instance's queues in
+    # turn and only sleep once they were all empty
+    while True:
+        received = lane_stats.received
+        for shard_queue in queues:
+            amqp.handle_items(shard_queue, _handle_adzerk_batch,
+                              limit=batch_size, drain=True, verbose=False)
+        if lane_stats.received == received:
+            time.sleep(batch_wait_ms / 1000.)
 
 AdzerkResponse = namedtuple('AdzerkResponse',
                     ['link', 'campaign', 'target', 'imp_pixel', 'click_url'])
 
-def adzerk_request(keywords, num_placements=1, timeout=10):
+ADZERK_ENGINE_URL = 'http://engine.adzerk.net/api/v2'
+
+_request_breaker = None
+_request_breaker_lock = threading.Lock()
+
+
+def get_request_breaker():
+    """Return the process-wide circuit breaker for the decision engine."""
+    global _request_breaker
+    if _request_breaker is None:
+        with _request_breaker_lock:
+            if _request_breaker is None:
+                _request_breaker = CircuitBreaker(
+                    'adzerk.request.breaker',
+                    failure_threshold=g.config.get(
+                        'az_request_breaker_threshold', 5),
+                    cooloff=g.config.get('az_request_breaker_cooloff', 30),
+                )
+    return _request_breaker
+
+
+def adzerk_request(keywords, num_placements=1, timeout=None):
+    """Ask the decision engine for ads targeted at keywords.
+
+    Requests are bounded by the az_request_timeout latency budget (in
+    seconds). Timeouts and errors trip a circuit breaker and while it is
+    open no request is made at all. Every failure returns None, the same
+    as no decision. Keyword sets that recently got no decision are
+    answered from the no-promo cache. Concurrent requests for the same
+    keywords may be merged into one engine call by the single-flight
+    layer, each caller still gets distinct decisions.
+
+    """
+
+    if timeout is None:
+        timeout = g.config.get('az_request_timeout', 0.1)
+
+    if keywords in get_no_promo_cache():
+        return None
+
+    singleflight = get_singleflight()
+    if singleflight:
+        return singleflight.do(
+            normalize_keywords(keywords),
+            num_placements,
+            lambda total: _adzerk_request(keywords, total, timeout,
+                                          keep_empty=True),
+            timeout,
+        )
+    return _adzerk_request(keywords, num_placements, timeout)
+
+
+def _adzerk_request(keywords, num_placements, timeout, keep_empty=False):
+    """Request num_placements decisions from the engine.
+
+    Divs that got no decision are left out of the result, or are None with
+    keep_empty so each position still matches its div.
+
+    """
+
+    breaker = get_request_breaker()
+    if not breaker.allow():
+        g.stats.simple_event('adzerk.request.short_circuit')
+        return None
+
     placements = []
     divs = ["div%s" % i for i in xrange(num_placements)]
     for div in divs:
@@ -411,31 +1434,60 @@ def adzerk_request(keywords, num_placements=1, timeout=10):
         "keywords": [word.lower() for word in keywords],
     }
 
-    url = 'http://engine.adzerk.net/api/v2'
+    url = ADZERK_ENGINE_URL
     headers = {'content-type': 'application/json'}
+    payload = json.dumps(data)
 
     timer = g.stats.get_timer("adzerk_timer")
     timer.start()
+    start = time.time()
 
+    transport = adzerk_api.get_engine_transport()
     try:
-        r = requests.post(url, data=json.dumps(data), headers=headers,
-                          timeout=timeout)
+        r = transport.request('POST', url, data=payload,
+                              headers=headers, timeout=timeout)
     except requests.exceptions.Timeout:
+        timer.stop()
+        instrument.record_call('adzerk_engine', 'decision', 'POST',
+                               time.time() - start, 'timeout', len(payload))
         g.log.info('adzerk request timeout')
+        breaker.record_failure()
+        return None
+    except requests.exceptions.RequestException as e:
+        timer.stop()
+        instrument.record_call('adzerk_engine', 'decision', 'POST',
+                               time.time() - start, 'error', len(payload))
+        g.log.info('adzerk request error: %s' % e)
+        breaker.record_failure()
         return None
 
     timer.stop()
+    instrument.record_call('adzerk_engine', 'decision', 'POST',
+                           time.time() - start, r.status_code, len(payload),
+                           instrument.response_size(r))
 
-    response = json.loads(r.text)
-    decisions = response['decisions']
+    try:
+        if not (200 <= r.status_code <= 299):
+            raise ValueError('response %s' % r.status_code)
+        response = json.loads(r.text)
+        decisions = response['decisions']
+    except (ValueError, KeyError) as e:
+        g.log.info('adzerk request bad response: %s' % e)
+        breaker.record_failure()
+        return None
 
-    if not decisions:
+    breaker.record_success()
+
+    if not decisions or not any(decisions.itervalues()):
+        get_no_promo_cache().add(keywords)
         return None
 
     res = []
     for div in divs:
         decision = decisions[div]
         if not decision:
+            if keep_empty:
+                res.append(None)
             continue
 
         imp_pixel = decision['impressionUrl']
@@ -459,14 +1511,25 @@ class AdzerkApiController(api.ApiController):
 
         # request multiple ads in case some are hidden by the builder due
         # to the user's hides/preferences
-        response = adzerk_request(srnames)
+        num_placements = max(g.az_selfserve_num_request or 1, 1)
+        response = adzerk_request(srnames, num_placements=num_placements)
 
         if not response:
             g.stats.simple_event('adzerk.request.no_promo')
             return
 
-        res_by_campaign = {r.campaign: r for r in response}
-        tuples = [promote.PromoTuple(r.link, 1., r.campaign) for r in response]
+        # the builder gets the decisions in the engine's rank order and
+        # shows the first one that the user is allowed to see
+        res_by_campaign = {}
+        rank_by_campaign = {}
+        tuples = []
+        for r in response:
+            if r.campaign in res_by_campaign:
+                continue
+            res_by_campaign[r.campaign] = r
+            rank_by_campaign[r.campaign] = len(tuples)
+            tuples.append(promote.PromoTuple(r.link, 1., r.campaign))
+
         builder = CampaignBuilder(tuples, wrap=default_thing_wrapper(),
                                   keep_fn=promote.is_promoted,
                                   num=1,
@@ -476,6 +1539,10 @@ class AdzerkApiController(api.ApiController):
             g.stats.simple_event('adzerk.request.valid_promo')
             w = listing.things[0]
             r = res_by_campaign[w.campaign]
+            if rank_by_campaign[w.campaign] > 0:
+                # the top decision was filtered out, a fallback filled the
+                # slot
+                g.stats.simple_event('adzerk.request.fallback_promo')
             w.adserver_imp_pixel = r.imp_pixel
             w.adserver_click_url = r.click_url
             return spaceCompress(w.render())
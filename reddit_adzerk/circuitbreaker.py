@@ -0,0 +1,65 @@
+import threading
+import time
+
+from pylons import g
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing dependency for a cool-off period.
+
+    After failure_threshold consecutive failures the breaker opens and
+    allow() returns False until cooloff seconds have passed. It then lets
+    a single trial call through (half open): success closes the breaker,
+    failure opens it for another cool-off period. State transitions are
+    counted as <name>.<state> events.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, cooloff=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooloff = cooloff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def _transition(self, state):
+        if state != self.state:
+            self.state = state
+            g.stats.simple_event('%s.%s' % (self.name, state))
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.cooloff):
+                self._transition(self.HALF_OPEN)
+                self.trial_in_flight = False
+
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial_in_flight = False
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self._transition(self.OPEN)
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import time
+
+from pylons import g
+
+
+def status_class(status_code):
+    return '%dxx' % (status_code // 100)
+
+
+class Breakdown(object):
+    """Where the wall time of one unit of work (e.g. a message) went.
+
+    Time is added under categories like api.campaign.put or lock.wait.
+    Work running concurrently in several threads adds up, so the totals
+    can exceed the wall time.
+
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, category, elapsed):
+        with self.lock:
+            self.times[category] += elapsed
+            self.counts[category] += 1
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def total(self, prefix):
+        with self.lock:
+            return sum(elapsed for category, elapsed in self.times.iteritems()
+                       if category.startswith(prefix))
+
+    def __str__(self):
+        with self.lock:
+            parts = ['%s=%.0fms/%d' % (category, elapsed * 1000,
+                                       self.counts[category])
+                     for category, elapsed in sorted(self.times.iteritems())]
+        return 'total=%.0fms %s' % (self.elapsed() * 1000, ' '.join(parts))
+
+
+_local = threading.local()
+
+
+def current_breakdown():
+    return getattr(_local, 'breakdown', None)
+
+
+@contextmanager
+def breakdown(existing=None):
+    """Collect timings made in the block, in this thread, into a Breakdown.
+
+    Passing an existing Breakdown lets other threads add to it.
+
+    """
+
+    previous = current_breakdown()
+    _local.breakdown = existing or Breakdown()
+    try:
+        yield _local.breakdown
+    finally:
+        _local.breakdown = previous
+
+
+def add_time(category, elapsed):
+    current = current_breakdown()
+    if current is not None:
+        current.add(category, elapsed)
+
+
+def record_call(service, resource, method, elapsed, status,
+                request_bytes=None, response_bytes=None):
+    """Record one HTTP call to an Adzerk endpoint.
+
+    status is the response's status code, or a string like 'timeout' or
+    'error' if there was no response. Emits <service>.<resource>.<verb>
+    timings and counters by status class, and the request and response
+    payload sizes in bytes as counters.
+
+    """
+
+    name = '.'.join((service, resource, method.lower()))
+    if not isinstance(status, basestring):
+        status = status_class(status)
+
+    g.stats.get_timer(name).send(status, elapsed)
+    g.stats.simple_event('%s.%s' % (name, status))
+    if request_bytes:
+        g.stats.simple_event('%s.request_bytes' % name, delta=request_bytes)
+    if response_bytes:
+        g.stats.simple_event('%s.response_bytes' % name,
+                             delta=response_bytes)
+    add_time('api.%s.%s' % (resource, method.lower()), elapsed)
+
+
+def response_size(response, streamed=False):
+    """Size of response's body, without reading it if it's streamed."""
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        return int(length)
+    if not streamed:
+        return len(response.content or '')
@@ -0,0 +1,99 @@
+import codecs
+import json
+import re
+
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Stream(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            chunk = self.utf8.decode(b'', final=True)
+        else:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8.decode(chunk)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('unexpected end of JSON')
+
+    def take(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError('expected %r, got %r' % (expected, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # a value ending exactly at the end of the buffer may be a
+                # number that continues in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return val
+            self.fill()
+
+
+def iter_array(chunks, key, meta=None):
+    """Yield the elements of one array in a JSON object as they arrive.
+
+    chunks is an iterable of str/unicode pieces of a JSON object, e.g.
+    response.iter_content(). Each element of the array under key is
+    decoded and yielded without holding the whole document in memory. The
+    other top level values are stored in meta if it's given.
+
+    """
+
+    stream = _Stream(chunks)
+    stream.take('{')
+    if stream.peek() == '}':
+        return
+
+    while True:
+        name = stream.value()
+        stream.take(':')
+        if name == key:
+            stream.take('[')
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.take(',]') == ']':
+                        break
+        else:
+            val = stream.value()
+            if meta is not None:
+                meta[name] = val
+
+        if stream.take(',}') == '}':
+            return
@@ -0,0 +1,119 @@
+from collections import OrderedDict
+import copy
+import threading
+import time
+
+from pylons import g
+
+
+# bump when the format of mirrored items changes so old entries are ignored
+MIRROR_VERSION = 1
+
+
+class Mirror(object):
+    """Read-through copy of Adzerk items, keyed by (resource, Id).
+
+    Items are the API's json for an object, as returned by a create or a
+    GET or as sent by a PUT. With use_memcache they're kept in memcache
+    and shared by every consumer process, otherwise in a per-process LRU
+    of at most size items. Entries expire after ttl seconds.
+
+    Every write made through adzerk_api overwrites the entry, and a
+    failed write drops it. An entry older than max_staleness seconds is
+    treated as a miss so the object is fetched again.
+
+    """
+
+    def __init__(self, ttl=3600, size=10000, use_memcache=False,
+                 max_staleness=None):
+        self.ttl = ttl
+        self.size = size
+        self.use_memcache = use_memcache
+        self.max_staleness = max_staleness
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            ttl=g.config.get('az_mirror_ttl', 0),
+            size=g.config.get('az_mirror_size', 10000),
+            use_memcache=g.config.get('az_mirror_memcache', False),
+            max_staleness=g.config.get('az_mirror_max_staleness', None),
+        )
+
+    def _key(self, resource, Id):
+        return 'adzerk_mirror-%s-%s-%s' % (MIRROR_VERSION, resource, Id)
+
+    def get(self, resource, Id, max_staleness=None):
+        """Return a copy of the mirrored item or None.
+
+        max_staleness overrides the mirror's own for this read, 0 always
+        misses.
+
+        """
+
+        if max_staleness is None:
+            max_staleness = self.max_staleness
+        if max_staleness == 0:
+            return None
+
+        key = self._key(resource, Id)
+        if self.use_memcache:
+            entry = g.cache.get(key)
+        else:
+            with self.lock:
+                entry = self.entries.pop(key, None)
+                if entry:
+                    self.entries[key] = entry
+
+        now = time.time()
+        if not entry or now - entry[0] >= self.ttl:
+            outcome = 'miss'
+            item = None
+        elif max_staleness is not None and now - entry[0] > max_staleness:
+            outcome = 'stale'
+            item = None
+        else:
+            outcome = 'hit'
+            item = copy.deepcopy(entry[1])
+
+        g.stats.simple_event('adzerk_mirror.%s.%s' % (resource, outcome))
+        return item
+
+    def put(self, resource, Id, item):
+        entry = (time.time(), copy.deepcopy(item))
+        key = self._key(resource, Id)
+        if self.use_memcache:
+            g.cache.set(key, entry, time=self.ttl)
+        else:
+            with self.lock:
+                self.entries.pop(key, None)
+                self.entries[key] = entry
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
+    def discard(self, resource, Id):
+        key = self._key(resource, Id)
+        if self.use_memcache:
+            g.cache.delete(key)
+        else:
+            with self.lock:
+                self.entries.pop(key, None)
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror():
+    """Return the process-wide Mirror or None if it is disabled."""
+    global _mirror
+    if not g.config.get('az_mirror_ttl', 0):
+        return None
+
+    if _mirror is None:
+        with _mirror_lock:
+            if _mirror is None:
+                _mirror = Mirror.from_config()
+    return _mirror
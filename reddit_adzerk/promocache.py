@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from pylons import g
+
+
+GENERATION_KEY = 'adzerk_no_promo_generation'
+
+
+def normalize_keywords(keywords):
+    return tuple(sorted(set(word.lower() for word in keywords)))
+
+
+class NoPromoCache(object):
+    """Short-lived cache of keyword sets the decision engine had no ad for.
+
+    Entries are kept in a per-process LRU of at most size keyword sets and,
+    if use_memcache is set, in memcache so all app servers share them.
+    Every entry expires after ttl seconds.
+
+    Flight targeting is changed from the adzerk_q consumer, a different
+    process, so invalidation goes through a generation token in memcache:
+    invalidate() replaces it and entries stored under an older generation
+    are ignored. The token is re-read at most every generation_ttl
+    seconds.
+
+    """
+
+    def __init__(self, ttl=60, size=1000, use_memcache=False,
+                 generation_ttl=5):
+        self.ttl = ttl
+        self.size = size
+        self.use_memcache = use_memcache
+        self.generation_ttl = generation_ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self._generation = None
+        self._generation_checked = 0
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            ttl=g.config.get('az_no_promo_cache_ttl', 60),
+            size=g.config.get('az_no_promo_cache_size', 1000),
+            use_memcache=g.config.get('az_no_promo_cache_memcache', False),
+        )
+
+    def generation(self):
+        now = time.time()
+        if now - self._generation_checked >= self.generation_ttl:
+            self._generation = g.cache.get(GENERATION_KEY)
+            self._generation_checked = now
+        return self._generation
+
+    def _memcache_key(self, key, generation):
+        digest = hashlib.md5('+'.join(key).encode('utf-8')).hexdigest()
+        return 'adzerk_no_promo-%s-%s' % (generation, digest)
+
+    def __contains__(self, keywords):
+        if not self.ttl:
+            return False
+
+        key = normalize_keywords(keywords)
+        generation = self.generation()
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > now and entry[1] == generation:
+                self.entries[key] = entry
+                hit = True
+            else:
+                hit = False
+
+        if not hit and self.use_memcache:
+            expires = g.cache.get(self._memcache_key(key, generation))
+            if expires and expires > now:
+                self._store_local(key, expires, generation)
+                hit = True
+
+        g.stats.simple_event('adzerk.no_promo_cache.%s' %
+                             ('hit' if hit else 'miss'))
+        return hit
+
+    def _store_local(self, key, expires, generation):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, generation)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def add(self, keywords):
+        if not self.ttl:
+            return
+
+        key = normalize_keywords(keywords)
+        generation = self.generation()
+        expires = time.time() + self.ttl
+        self._store_local(key, expires, generation)
+        if self.use_memcache:
+            g.cache.set(self._memcache_key(key, generation), expires,
+                        time=self.ttl)
+
+    def invalidate(self):
+        """Drop every entry, in this process and (eventually) all others."""
+        generation = '%f' % time.time()
+        g.cache.set(GENERATION_KEY, generation)
+        with self.lock:
+            self.entries.clear()
+            self._generation = generation
+            self._generation_checked = time.time()
+
+
+_no_promo_cache = None
+_no_promo_cache_lock = threading.Lock()
+
+
+def get_no_promo_cache():
+    global _no_promo_cache
+    if _no_promo_cache is None:
+        with _no_promo_cache_lock:
+            if _no_promo_cache is None:
+                _no_promo_cache = NoPromoCache.from_config()
+    return _no_promo_cache
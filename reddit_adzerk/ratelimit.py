@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+
+from pylons import g
+
+
+RETRY_STATUSES = (429, 503)
+
+
+def is_retryable(method, status):
+    """Whether a call that got status can safely be made again.
+
+    A 429 means the call was rejected before it was applied. A 503 may come
+    after the API applied it, so a POST (which creates an object) isn't
+    retried then, a second attempt could create a duplicate.
+
+    """
+
+    if method == 'POST':
+        return status == 429
+    return status in RETRY_STATUSES
+
+
+class TokenBucket(object):
+    """Process-wide token bucket allowing rate calls per second.
+
+    Up to burst calls can be made at once after a quiet period. The rate
+    adapts to the API's limit: throttle() halves it when a call was
+    rejected, and every successful call (relax()) raises it back towards
+    the configured rate a little.
+
+    """
+
+    def __init__(self, rate, burst=None, min_rate=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16.
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take a token, waiting for one if needed. Returns the wait."""
+        waited = 0
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2.)
+            self.tokens = min(self.tokens, 0)
+
+    def relax(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate / 20.)
+
+
+class MemcacheTokenBucket(TokenBucket):
+    """TokenBucket whose calls are also counted across processes.
+
+    Every process on the cluster increments a memcache counter per second.
+    Once the counter reaches the shared rate, callers wait for the next
+    second. The local bucket still smooths bursts within a process.
+
+    """
+
+    KEY_PREFIX = 'adzerk_api_rate-'
+
+    def acquire(self):
+        waited = super(MemcacheTokenBucket, self).acquire()
+        while True:
+            now = time.time()
+            window = int(now)
+            key = self.KEY_PREFIX + str(window)
+            g.cache.add(key, 0, time=10)
+            count = g.cache.incr(key)
+            if count is None or count <= self.rate:
+                # fail open if memcache is unavailable
+                return waited
+            wait = window + 1 - now
+            time.sleep(wait)
+            waited += wait
+
+
+def backoff_delay(attempt, response=None, base=0.5, cap=30):
+    """Seconds to wait before retry number attempt (counting from 0).
+
+    A Retry-After header (in seconds) wins. Otherwise it's exponential
+    backoff with full jitter.
+
+    """
+
+    retry_after = None
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            return min(cap, max(0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def get_bucket():
+    """Return the process-wide TokenBucket or None if it is disabled."""
+    global _bucket
+    rate = g.config.get('az_api_rate_limit', 0)
+    if not rate:
+        return None
+
+    if _bucket is None:
+        with _bucket_lock:
+            if _bucket is None:
+                if g.config.get('az_api_rate_limit_memcache', False):
+                    cls = MemcacheTokenBucket
+                else:
+                    cls = TokenBucket
+                _bucket = cls(rate, burst=g.config.get('az_api_burst', None))
+    return _bucket
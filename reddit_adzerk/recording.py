@@ -0,0 +1,189 @@
+from collections import defaultdict, deque
+import json
+import re
+import threading
+import time
+
+from pylons import g
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+# response headers worth keeping, everything else is dropped
+RECORDED_HEADERS = ('Content-Type', 'Retry-After')
+
+REDACTED = 'REDACTED'
+APIKEY_PARAM = re.compile(r'(?i)(api_?key=)[^&]*')
+
+
+class ReplayMismatch(Exception): pass
+
+
+def full_url(method, url, params=None):
+    if params:
+        url = requests.Request(method, url, params=params).prepare().url
+    return APIKEY_PARAM.sub(r'\1' + REDACTED, url)
+
+
+def _text(data):
+    if data is None:
+        return None
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    if isinstance(data, basestring):
+        return data
+    return json.dumps(data, sort_keys=True)
+
+
+class Recorder(object):
+    """Append request/response exchanges to a file, one JSON line each.
+
+    Request headers, and so the API key, are never written. Streamed
+    responses are read in full to be recorded.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, exchange):
+        line = json.dumps(exchange, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_exchanges(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class RecordingTransport(object):
+    """Wrap a Transport, recording every exchange made through it."""
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    def request(self, method, url, **kw):
+        exchange = {
+            'started': time.time(),
+            'method': method,
+            'url': full_url(method, url, kw.get('params')),
+            'body': _text(kw.get('data')),
+        }
+        start = time.time()
+        try:
+            response = self.transport.request(method, url, **kw)
+            exchange['status'] = response.status_code
+            exchange['headers'] = {
+                name: response.headers[name] for name in RECORDED_HEADERS
+                if name in response.headers
+            }
+            # reads the content of a streamed response too
+            exchange['response'] = response.text
+        except requests.exceptions.Timeout:
+            exchange['error'] = 'timeout'
+            raise
+        except requests.exceptions.RequestException as e:
+            exchange['error'] = 'error'
+            exchange['message'] = str(e)
+            raise
+        finally:
+            exchange['elapsed'] = time.time() - start
+            self.recorder.write(exchange)
+        return response
+
+    def close(self):
+        self.transport.close()
+        self.recorder.close()
+
+
+class ReplayTransport(object):
+    """Serve recorded exchanges instead of making requests.
+
+    In 'order' mode exchanges are returned in the order they were
+    recorded and a request for a different method and url than the next
+    recording raises ReplayMismatch. In 'key' mode they're matched by
+    method, url and body. Repeated requests get the recordings in turn,
+    and the last one again once they run out. Each reply is delayed by
+    its recorded latency times latency_scale (0 to not wait at all).
+
+    """
+
+    def __init__(self, exchanges, mode='order', latency_scale=1.0):
+        if mode not in ('order', 'key'):
+            raise ValueError('unknown replay mode %r' % mode)
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.ordered = deque(exchanges)
+        self.by_key = defaultdict(deque)
+        for exchange in exchanges:
+            self.by_key[self._key(exchange)].append(exchange)
+        self.served = 0
+        self.misses = 0
+
+    @classmethod
+    def from_file(cls, path, mode='order', latency_scale=1.0):
+        return cls(load_exchanges(path), mode=mode,
+                   latency_scale=latency_scale)
+
+    @staticmethod
+    def _key(exchange):
+        return (exchange['method'], exchange['url'], exchange['body'])
+
+    def _next(self, method, url, body):
+        with self.lock:
+            if self.mode == 'order':
+                if not self.ordered:
+                    self.misses += 1
+                    raise ReplayMismatch('recording exhausted at %s %s' %
+                                         (method, url))
+                exchange = self.ordered.popleft()
+                if (exchange['method'], exchange['url']) != (method, url):
+                    self.misses += 1
+                    raise ReplayMismatch('expected %s %s, got %s %s' % (
+                        exchange['method'], exchange['url'], method, url))
+            else:
+                recorded = self.by_key.get((method, url, body))
+                if not recorded:
+                    self.misses += 1
+                    raise ReplayMismatch('no recording for %s %s' %
+                                         (method, url))
+                exchange = (recorded.popleft() if len(recorded) > 1
+                            else recorded[0])
+            self.served += 1
+            return exchange
+
+    def request(self, method, url, **kw):
+        exchange = self._next(method, full_url(method, url, kw.get('params')),
+                              _text(kw.get('data')))
+        if self.latency_scale:
+            time.sleep(exchange['elapsed'] * self.latency_scale)
+
+        error = exchange.get('error')
+        if error == 'timeout':
+            raise requests.exceptions.Timeout('replayed timeout')
+        elif error:
+            raise requests.exceptions.ConnectionError(
+                exchange.get('message', 'replayed error'))
+
+        response = requests.Response()
+        response.status_code = exchange['status']
+        response.headers = CaseInsensitiveDict(exchange.get('headers') or {})
+        response.url = exchange['url']
+        response.encoding = 'utf-8'
+        response._content = exchange['response'].encode('utf-8')
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        g.log.info('adzerk replay served %d exchanges, %d misses' %
+                   (self.served, self.misses))
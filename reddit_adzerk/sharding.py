@@ -0,0 +1,60 @@
+import hashlib
+
+
+# every lane queue is split into this many shard queues. it is fixed so a
+# link's messages always land on the same queue however many consumers
+# there are, changing it moves about 1 / NUM_SHARDS of the links. it is
+# also the most consumer instances a sharded lane can use.
+NUM_SHARDS = 8
+
+
+def jump_hash(key, num_buckets):
+    """Jump consistent hash of integer key into range(num_buckets).
+
+    Going from n to n + 1 buckets only moves 1 / (n + 1) of the keys.
+    See Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash".
+
+    """
+
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_for(fullname, num_shards=NUM_SHARDS):
+    digest = hashlib.md5(fullname.encode('utf-8')).hexdigest()
+    return jump_hash(int(digest[:16], 16), num_shards)
+
+
+def shard_queue(queue, shard):
+    return '%s_%d' % (queue, shard)
+
+
+def shard_queues(queue, num_shards=NUM_SHARDS):
+    return [shard_queue(queue, shard) for shard in xrange(num_shards)]
+
+
+def shards_for_instance(instance, num_instances, num_shards=NUM_SHARDS):
+    """Shards consumed by consumer instance out of num_instances.
+
+    Instances are numbered from 0. With as many instances as shards each
+    consumes exactly one. When the instance count changes the shards are
+    dealt out again and the queued messages wait in their shard queue for
+    its new owner, so all the work for a link still goes to a single
+    process. More instances than shards would leave some without work and
+    an instance number outside the count would share a shard with another
+    instance, both are refused.
+
+    """
+
+    if not 0 < num_instances <= num_shards:
+        raise ValueError('%d consumer instances, a sharded lane needs '
+                         'between 1 and %d' % (num_instances, num_shards))
+    if not 0 <= instance < num_instances:
+        raise ValueError('consumer instance %d is not in range(%d)' %
+                         (instance, num_instances))
+    return [shard for shard in xrange(num_shards)
+            if shard % num_instances == instance]
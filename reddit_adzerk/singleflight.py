@@ -0,0 +1,94 @@
+import threading
+import time
+
+from pylons import g
+
+
+class _Call(object):
+    def __init__(self):
+        self.placements = []
+        self.results = None
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """Share one decision request between concurrent identical requests.
+
+    The first caller for a key waits window seconds for other callers with
+    the same key to join (at most max_shared in total) and then makes a
+    single request for all of their placements. The decisions are split
+    between the callers in join order, so each gets its own decisions
+    with their own impression pixels and click urls and nothing is counted
+    twice. Callers arriving after the request was sent start a new one.
+
+    """
+
+    def __init__(self, window, max_shared=8):
+        self.window = window
+        self.max_shared = max_shared
+        self.gathering = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, num_placements, fn, timeout):
+        """Return this caller's share of fn(total_placements).
+
+        fn must return None or a list with one entry per placement it is
+        given, None for placements that got no decision, so each caller's
+        share can be sliced by position. Those empty entries are dropped
+        from the share returned. timeout bounds how long a caller that
+        joined someone else's request waits for it.
+
+        """
+
+        with self.lock:
+            call = self.gathering.get(key)
+            if call and len(call.placements) < self.max_shared:
+                is_leader = False
+            else:
+                call = self.gathering[key] = _Call()
+                is_leader = True
+            index = len(call.placements)
+            call.placements.append(num_placements)
+
+        if is_leader:
+            time.sleep(self.window)
+            with self.lock:
+                if self.gathering.get(key) is call:
+                    del self.gathering[key]
+            shared = len(call.placements)
+            if shared > 1:
+                g.stats.simple_event('adzerk.request.singleflight.shared',
+                                     delta=shared - 1)
+            try:
+                call.results = fn(sum(call.placements))
+            finally:
+                call.done.set()
+        elif not call.done.wait(self.window + timeout):
+            return None
+
+        if not call.results:
+            return None
+        start = sum(call.placements[:index])
+        share = call.results[start:start + num_placements]
+        return [result for result in share if result is not None] or None
+
+
+_singleflight = None
+_singleflight_lock = threading.Lock()
+
+
+def get_singleflight():
+    """Return the process-wide SingleFlight or None if it is disabled."""
+    global _singleflight
+    window_ms = g.config.get('az_singleflight_window_ms', 0)
+    if not window_ms:
+        return None
+
+    if _singleflight is None:
+        with _singleflight_lock:
+            if _singleflight is None:
+                _singleflight = SingleFlight(
+                    window=window_ms / 1000.,
+                    max_shared=g.config.get('az_singleflight_max_shared', 8),
+                )
+    return _singleflight
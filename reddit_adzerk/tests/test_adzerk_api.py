@@ -0,0 +1,68 @@
+import unittest
+
+from reddit_adzerk.adzerk_api import Campaign, _RawItems
+
+
+def campaign_item():
+    return {
+        'Id': 1,
+        'Name': 'campaign',
+        'AdvertiserId': 2,
+        'StartDate': '/Date(0)/',
+        'IsDeleted': False,
+        'IsActive': True,
+        'Price': 0,
+        'Unknown': 5,
+        'Flights': [{
+            'Id': 3,
+            'StartDate': '/Date(0)/',
+            'Price': 1,
+            'OptionType': 1,
+            'Impressions': 100,
+            'IsUnlimited': False,
+            'IsFullSpeed': False,
+            'CampaignId': 1,
+            'PriorityId': 4,
+            'IsDeleted': False,
+            'IsActive': True,
+            'Unknown': 7,
+            'CreativeMaps': [{
+                'Id': 5,
+                'CampaignId': 1,
+                'PublisherAccountId': 6,
+                'IsDeleted': False,
+                'Percentage': 100,
+                'Creative': {'Id': 8},
+                'IsActive': True,
+                'FlightId': 3,
+                'Impressions': 100,
+                'DistributionType': 1,
+                'Unknown': 9,
+            }],
+        }],
+    }
+
+
+class NestedTest(unittest.TestCase):
+    def test_raw_items_serialize_like_read_items(self):
+        raw = Campaign._from_item(campaign_item())
+        read = Campaign._from_item(campaign_item())
+        read.Flights[0].CreativeMaps
+
+        self.assertEqual(raw._to_item(), read._to_item())
+
+    def test_unknown_fields_not_sent(self):
+        item = Campaign._from_item(campaign_item())._to_item()
+
+        flight = item['Flights'][0]
+        self.assertNotIn('Unknown', item)
+        self.assertNotIn('Unknown', flight)
+        self.assertNotIn('Unknown', flight['CreativeMaps'][0])
+        self.assertEqual(flight['Name'], '')
+        self.assertEqual(flight['CreativeMaps'][0]['Creative'], {'Id': 8})
+
+    def test_to_item_leaves_raw_items(self):
+        campaign = Campaign._from_item(campaign_item())
+        campaign._to_item()
+
+        self.assertIsInstance(campaign._Flights, _RawItems)
@@ -0,0 +1,287 @@
+import unittest
+
+from mock import MagicMock, patch
+
+from reddit_adzerk import adzerk_api, adzerkpromote
+from reddit_adzerk.adzerkpromote import (
+    CREATE,
+    NONE,
+    UPDATE,
+    Plan,
+    Ref,
+    coalesce_messages,
+    desired_state,
+    RemoteState,
+    fingerprint,
+    plan_adzerk,
+    reconcile_adzerk_promotions,
+)
+
+
+KINDS = ('campaign', 'creative', 'flight', 'cfmap')
+
+
+class FakeThing(object):
+    _deleted = False
+
+    def __init__(self, fullname, **attrs):
+        self._fullname = fullname
+        for attr, val in attrs.iteritems():
+            setattr(self, attr, val)
+
+
+class Remote(object):
+    """Adzerk object as returned by a GET, with the given attributes."""
+
+    def __init__(self, Id, **attrs):
+        self.Id = Id
+        for attr, val in attrs.iteritems():
+            if isinstance(val, dict):
+                val = adzerk_api.Stub(val['Id'])
+            setattr(self, attr, val)
+
+
+class SyncTestCase(unittest.TestCase):
+    """A link and campaign with the Adzerk model GETs mocked out."""
+
+    def setUp(self):
+        g = MagicMock()
+        g.az_selfserve_advertiser_id = 1
+        g.az_selfserve_ad_type = 2
+        g.az_selfserve_priority_id = 3
+        patches = [
+            patch.object(adzerkpromote, 'g', g),
+            patch.object(adzerkpromote, 'date_to_adzerk',
+                         lambda d: '/Date(%s)/' % d),
+            patch.object(adzerkpromote, 'render_link',
+                         lambda link, campaign: 'rendered'),
+        ]
+        self.gets = {}
+        for kind, model in (('campaign', adzerk_api.Campaign),
+                            ('creative', adzerk_api.Creative),
+                            ('flight', adzerk_api.Flight),
+                            ('cfmap', adzerk_api.CreativeFlightMap)):
+            self.gets[kind] = MagicMock()
+            patches.append(patch.object(model, 'get', self.gets[kind]))
+
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.link = FakeThing('t3_1')
+        self.campaign = FakeThing('t8_1', start_date=1, end_date=2,
+                                  sr_name='pics', bid=10., ndays=2)
+
+    def set_ids(self):
+        self.link.adzerk_campaign_id = 10
+        self.campaign.adzerk_creative_id = 20
+        self.campaign.adzerk_flight_id = 30
+        self.campaign.adzerk_cfmap_id = 40
+
+    def set_fingerprints(self):
+        plan = Plan(self.link, self.campaign)
+        for kind in KINDS:
+            spec = adzerkpromote.OBJECT_SPECS[kind]
+            owner = spec.owner(self.link, self.campaign)
+            setattr(owner, spec.fingerprint_attr,
+                    fingerprint(desired_state(plan, kind)))
+
+    def set_remotes(self, **overrides):
+        plan = Plan(self.link, self.campaign)
+        for kind in KINDS:
+            spec = adzerkpromote.OBJECT_SPECS[kind]
+            Id = getattr(spec.owner(self.link, self.campaign), spec.id_attr)
+            attrs = dict(desired_state(plan, kind), **overrides.get(kind, {}))
+            self.gets[kind].return_value = Remote(Id, **attrs)
+
+    def get_count(self):
+        return sum(get.call_count for get in self.gets.itervalues())
+
+
+class PlanAdzerkTest(SyncTestCase):
+    def test_new_campaign(self):
+        plan = plan_adzerk(self.link, self.campaign)
+
+        self.assertEqual(len(plan.writes()), 4)
+        self.assertEqual([step.op for step in plan], [CREATE] * 4)
+        self.assertEqual(self.get_count(), 0)
+        cfmap = plan.steps['cfmap']
+        self.assertIsInstance(cfmap.desired['FlightId'], Ref)
+        self.assertIsInstance(cfmap.desired['Creative']['Id'], Ref)
+
+    def test_unchanged(self):
+        self.set_ids()
+        self.set_fingerprints()
+
+        plan = plan_adzerk(self.link, self.campaign)
+
+        self.assertEqual(len(plan.writes()), 0)
+        self.assertEqual(self.get_count(), 0)
+
+    def test_forced_unchanged(self):
+        self.set_ids()
+        self.set_fingerprints()
+        self.set_remotes()
+
+        plan = plan_adzerk(self.link, self.campaign, force=True)
+
+        self.assertEqual(len(plan.writes()), 0)
+        self.assertEqual(self.get_count(), 4)
+
+    def test_changed(self):
+        self.set_ids()
+        self.set_remotes(flight={'Keywords': 'funny'})
+
+        plan = plan_adzerk(self.link, self.campaign)
+
+        writes = plan.writes()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(writes[0].kind, 'flight')
+        self.assertEqual(writes[0].op, UPDATE)
+        self.assertEqual(writes[0].attrs, {'Keywords': 'pics'})
+
+    def test_deactivate_campaign(self):
+        self.set_ids()
+        self.set_remotes()
+
+        plan = plan_adzerk(self.link, self.campaign, 'deactivate_campaign',
+                           force=True)
+
+        writes = plan.writes()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(writes[0].kind, 'flight')
+        self.assertEqual(writes[0].attrs, {'IsActive': False})
+        self.assertEqual(self.get_count(), 1)
+
+    def test_deactivate_link(self):
+        self.set_ids()
+        self.set_remotes()
+
+        plan = plan_adzerk(self.link, None, 'deactivate_link', force=True)
+
+        writes = plan.writes()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(writes[0].kind, 'campaign')
+        self.assertEqual(writes[0].attrs, {'IsActive': False})
+
+    def test_deactivate_inactive(self):
+        self.set_ids()
+        self.set_remotes(flight={'IsActive': False})
+
+        plan = plan_adzerk(self.link, self.campaign, 'deactivate_campaign',
+                           force=True)
+
+        self.assertEqual(len(plan.writes()), 0)
+        self.assertEqual(plan.steps['flight'].op, NONE)
+
+
+class ReconcileTest(SyncTestCase):
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        self.set_ids()
+        self.set_fingerprints()
+        self.update_adzerk = MagicMock()
+        patches = [
+            patch.object(adzerkpromote, 'get_live_campaigns',
+                         lambda offset: [(self.link, self.campaign, False)]),
+            patch.object(adzerkpromote, '_update_adzerk', self.update_adzerk),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def listed(self, **overrides):
+        """RemoteState as listed, without the flights' CreativeMaps."""
+        plan = Plan(self.link, self.campaign)
+        things = {}
+        for kind in ('campaign', 'creative', 'flight'):
+            spec = adzerkpromote.OBJECT_SPECS[kind]
+            Id = getattr(spec.owner(self.link, self.campaign), spec.id_attr)
+            attrs = dict(desired_state(plan, kind), **overrides.get(kind, {}))
+            things[kind] = [Remote(Id, **attrs)]
+        return RemoteState(things['campaign'], things['flight'],
+                           things['creative'])
+
+    def reconcile(self, remote):
+        with patch.object(RemoteState, 'fetch',
+                          MagicMock(return_value=remote)):
+            reconcile_adzerk_promotions()
+
+    def test_unchanged(self):
+        self.reconcile(self.listed())
+
+        self.assertEqual(self.get_count(), 0)
+        self.assertFalse(self.update_adzerk.called)
+
+    def test_changed(self):
+        self.reconcile(self.listed(flight={'Keywords': 'funny'}))
+
+        self.assertEqual(self.update_adzerk.call_count, 1)
+
+    def test_cfmap_fingerprint_changed(self):
+        self.campaign.adzerk_cfmap_fingerprint = 'stale'
+
+        self.reconcile(self.listed())
+
+        self.assertEqual(self.update_adzerk.call_count, 1)
+
+
+def update(link, campaign, force=False):
+    return {'action': 'update_adzerk', 'link': link, 'campaign': campaign,
+            'force': force}
+
+
+def deactivate_campaign(link, campaign):
+    return {'action': 'deactivate_campaign', 'link': link,
+            'campaign': campaign}
+
+
+def deactivate_link(link):
+    return {'action': 'deactivate_link', 'link': link}
+
+
+class CoalesceMessagesTest(unittest.TestCase):
+    def test_distinct(self):
+        messages = [update('t3_1', 't8_1'), update('t3_1', 't8_2'),
+                    update('t3_2', 't8_3')]
+        self.assertEqual(coalesce_messages(messages), messages)
+
+    def test_keeps_last_per_campaign(self):
+        first = update('t3_1', 't8_1')
+        other = update('t3_2', 't8_2')
+        last = deactivate_campaign('t3_1', 't8_1')
+
+        self.assertEqual(coalesce_messages([first, other, last]),
+                         [other, last])
+
+    def test_deactivate_link_supersedes_updates(self):
+        messages = [update('t3_1', 't8_1'), update('t3_2', 't8_2'),
+                    update('t3_1', 't8_3'), deactivate_link('t3_1')]
+
+        self.assertEqual(coalesce_messages(messages),
+                         [update('t3_2', 't8_2'), deactivate_link('t3_1')])
+
+    def test_deactivate_link_keeps_deactivate_campaign(self):
+        messages = [update('t3_1', 't8_1'),
+                    deactivate_campaign('t3_1', 't8_3'),
+                    deactivate_link('t3_1')]
+
+        self.assertEqual(coalesce_messages(messages),
+                         [deactivate_campaign('t3_1', 't8_3'),
+                          deactivate_link('t3_1')])
+
+    def test_force_carries_over(self):
+        messages = [update('t3_1', 't8_1', force=True),
+                    update('t3_1', 't8_1')]
+
+        self.assertEqual(coalesce_messages(messages),
+                         [update('t3_1', 't8_1', force=True)])
+
+    def test_force_not_carried_to_other_action(self):
+        messages = [update('t3_1', 't8_1', force=True),
+                    deactivate_campaign('t3_1', 't8_1')]
+
+        coalesced = coalesce_messages(messages)
+
+        self.assertEqual(coalesced, [deactivate_campaign('t3_1', 't8_1')])
+        self.assertNotIn('force', coalesced[0])
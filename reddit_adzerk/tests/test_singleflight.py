@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+import unittest
+
+from mock import MagicMock, patch
+
+from reddit_adzerk import adzerk_api, adzerkpromote, singleflight
+from reddit_adzerk.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        p = patch.object(singleflight, 'g', MagicMock())
+        p.start()
+        self.addCleanup(p.stop)
+        self.singleflight = SingleFlight(window=0.2)
+        self.totals = []
+
+    def run_callers(self, placements, results):
+        """Run one caller per entry of placements against one shared call."""
+
+        def fn(total):
+            self.totals.append(total)
+            return results
+
+        shares = {}
+
+        def caller(name, num_placements):
+            shares[name] = self.singleflight.do('key', num_placements, fn,
+                                                timeout=1)
+
+        threads = []
+        for name, num_placements in placements:
+            thread = threading.Thread(target=caller,
+                                      args=(name, num_placements))
+            thread.start()
+            threads.append(thread)
+            # let the leader register its call before the others join
+            while 'key' not in self.singleflight.gathering:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        return shares
+
+    def test_shares_one_call(self):
+        shares = self.run_callers([('A', 1), ('B', 1)], ['X', 'Y'])
+
+        self.assertEqual(self.totals, [2])
+        self.assertEqual(shares, {'A': ['X'], 'B': ['Y']})
+
+    def test_empty_div_before_follower(self):
+        shares = self.run_callers([('A', 1), ('B', 1)], [None, 'Y'])
+
+        self.assertEqual(shares, {'A': None, 'B': ['Y']})
+
+    def test_empty_divs_within_share(self):
+        shares = self.run_callers([('A', 2), ('B', 2)],
+                                  ['W', None, None, 'Z'])
+
+        self.assertEqual(self.totals, [4])
+        self.assertEqual(shares, {'A': ['W'], 'B': ['Z']})
+
+    def test_no_decisions(self):
+        shares = self.run_callers([('A', 1), ('B', 1)], None)
+
+        self.assertEqual(shares, {'A': None, 'B': None})
+
+
+class AdzerkRequestTest(unittest.TestCase):
+    def setUp(self):
+        response = MagicMock(status_code=200, headers={})
+        response.text = json.dumps({'decisions': {
+            'div0': None,
+            'div1': {
+                'impressionUrl': 'imp',
+                'clickUrl': 'click',
+                'contents': [{'body': json.dumps({
+                    'link': 't3_1', 'campaign': 't8_1', 'target': 'pics',
+                })}],
+            },
+        }})
+        transport = MagicMock()
+        transport.request.return_value = response
+        g = MagicMock()
+        g.az_selfserve_network_id = 1
+        g.az_selfserve_site_id = 2
+        g.az_selfserve_ad_type = 3
+
+        patches = [
+            patch.object(adzerkpromote, 'g', g),
+            patch.object(adzerkpromote, 'get_request_breaker', MagicMock()),
+            patch.object(adzerkpromote.instrument, 'record_call',
+                         MagicMock()),
+            patch.object(adzerk_api, 'get_engine_transport',
+                         MagicMock(return_value=transport)),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_drops_empty_divs(self):
+        res = adzerkpromote._adzerk_request(['pics'], 2, timeout=1)
+
+        self.assertEqual([r.campaign for r in res], ['t8_1'])
+
+    def test_keep_empty_divs(self):
+        res = adzerkpromote._adzerk_request(['pics'], 2, timeout=1,
+                                            keep_empty=True)
+
+        self.assertEqual(len(res), 2)
+        self.assertIsNone(res[0])
+        self.assertEqual(res[1].campaign, 't8_1')
@@ -0,0 +1,122 @@
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from pylons import c, g
+
+import adzerk_api
+import instrument
+
+
+class ContextThreadPool(object):
+    """Bounded thread pool that runs work in the submitter's context.
+
+    pylons globals are thread local, so the caller's g and c are pushed in
+    each worker for the duration of the call. The caller's adzerk_api unit
+    of work is joined too so objects fetched by one worker are visible to
+    the others, and so is its instrument breakdown.
+
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = ThreadPool(processes)
+
+    def apply_async(self, fn, *a, **kw):
+        g_obj = g._current_obj()
+        c_obj = c._current_obj()
+        identity_map = adzerk_api.current_identity_map()
+        breakdown = instrument.current_breakdown()
+
+        def run():
+            g._push_object(g_obj)
+            c._push_object(c_obj)
+            try:
+                with adzerk_api.unit_of_work(identity_map), \
+                        instrument.breakdown(breakdown):
+                    return fn(*a, **kw)
+            finally:
+                c._pop_object(c_obj)
+                g._pop_object(g_obj)
+
+        return self.pool.apply_async(run)
+
+    def close(self):
+        """Finish the submitted work and stop the worker threads."""
+        self.pool.close()
+        self.pool.join()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(name, processes):
+    """Return the process-wide pool called name, or None to run serially."""
+    if processes <= 1:
+        return None
+
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None or pool.processes != processes:
+            pool = _pools[name] = ContextThreadPool(processes)
+    return pool
+
+
+def close_pools():
+    """Close every process-wide pool, e.g. before a script exits."""
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def timed(name, fn, *a, **kw):
+    timer = g.stats.get_timer('adzerk_stage.%s' % name)
+    timer.start()
+    start = time.time()
+    try:
+        return fn(*a, **kw)
+    finally:
+        timer.stop()
+        instrument.add_time('stage.%s' % name, time.time() - start)
+
+
+def run_stages(stages, pool=None):
+    """Run a dependency graph of named stages.
+
+    stages is a list of (name, fn, dependencies) tuples. Each stage runs
+    once all its dependencies have finished and stages that are ready at
+    the same time run concurrently in pool. Without a pool the stages run
+    one by one in list order. Returns a dict of each stage's result.
+
+    Every submitted stage has finished by the time this returns or raises,
+    so a caller holding a lock doesn't release it under a running stage.
+    There's no timeout here, stages are bounded by their HTTP timeouts.
+
+    """
+
+    results = {}
+
+    if pool is None:
+        for name, fn, dependencies in stages:
+            results[name] = timed(name, fn)
+        return results
+
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining
+                 if all(dep in results for dep in stage[2])]
+        if not ready:
+            names = ', '.join(stage[0] for stage in remaining)
+            raise ValueError('unsatisfiable stage dependencies: %s' % names)
+
+        pending = [(name, pool.apply_async(timed, name, fn))
+                   for name, fn, dependencies in ready]
+        for name, async_result in pending:
+            async_result.wait()
+        for name, async_result in pending:
+            results[name] = async_result.get()
+        remaining = [stage for stage in remaining if stage not in ready]
+    return results